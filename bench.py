@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+"""Benchmarks for the library browsing & streaming, against a synthetic library generated with ffmpeg.
+
+Results are printed as JSON so they can be saved and compared against other versions, e.g.:
+    ./bench.py --output results-$(git describe --always).json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# NOTE: The project's modules are imported in main(), after XDG_CACHE_HOME is pointed somewhere temporary,
+#       since the caches get set up on import and I don't want benchmark junk in the real ones.
+
+# Which HLS/caption benchmarks to run, as (name, ffmpeg video args, ffmpeg audio args).
+# 'copy' can be passed through as is, 'transcode' can't be played by any of the clients so has to be transcoded.
+_SOURCE_CLIPS = [
+    ('copy', ['-codec:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p'], ['-codec:a', 'aac']),
+    ('transcode', ['-codec:v', 'mpeg4', '-qscale:v', '5'], ['-codec:a', 'ac3']),
+]
+_SUBTITLE_LANGUAGES = ['eng', 'fre']
+
+
+def _ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-nostdin', '-y', *args], check=True)
+
+
+def _link(src, dst):
+    """Hardlink src to dst if possible, since it's quicker and uses no space, otherwise copy it"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _write_info(path, title):
+    # Same format as UPMC's .info files, see vfs._Metadata
+    with open(path, 'w') as f:
+        f.write('[local]\ntitle = {title}\n\n[IMDB]\ntitle = {title}\nplot = Generated for benchmarking | \n'.format(
+            title=title))
+
+
+def _make_clip(path, duration, video_args, audio_args):
+    """Generate a test pattern video with a tone and a few subtitle tracks embedded"""
+    srt_path = path + '.srt'
+    with open(srt_path, 'w') as f:
+        for i in range(int(duration)):
+            timestamp = '{:02d}:{:02d}:{:02d}'.format(i // 3600, i // 60 % 60, i % 60)
+            f.write('{n}\n{t},000 --> {t},900\nSubtitle number {n}\n\n'.format(n=i + 1, t=timestamp))
+    subtitle_args = []
+    for _ in _SUBTITLE_LANGUAGES:
+        subtitle_args.extend(('-i', srt_path))
+    maps = ['-map', '0:v', '-map', '1:a']
+    for i, language in enumerate(_SUBTITLE_LANGUAGES):
+        maps.extend(('-map', '{}:s'.format(i + 2), '-metadata:s:s:{}'.format(i), 'language={}'.format(language)))
+    _ffmpeg('-f', 'lavfi', '-i', 'testsrc=duration={}:size=1280x720:rate=25'.format(duration),
+            '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration),
+            *subtitle_args, *maps, *video_args, *audio_args, '-codec:s', 'srt', path)
+    os.remove(srt_path)
+
+
+def generate_library(root, folder_sizes, shows, duration):
+    """Build a synthetic media library under root.
+
+    Layout:
+        Sized/<n>/          n videos each with a .info & .jpg, for timing folder listings by size
+        TV/<show>/Season N/ nested folders with folder.jpg covers
+        Latest/             symlinks into TV/, like a "recently added" folder
+        Bench/<clip>/       a single video each, for the HLS & caption benchmarks
+    """
+    print("Generating library in", root, file=sys.stderr)
+    source_dir = os.path.join(root, '.sources')
+    os.makedirs(source_dir)
+    cover = os.path.join(source_dir, 'cover.jpg')
+    _ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=1000x1500', '-frames:v', '1', cover)
+    clips = {}
+    for name, video_args, audio_args in _SOURCE_CLIPS:
+        clips[name] = os.path.join(source_dir, name + '.mkv')
+        _make_clip(clips[name], duration, video_args, audio_args)
+
+    for size in folder_sizes:
+        for i in range(size):
+            base = os.path.join(root, 'Sized', str(size), 'Video {:05d}'.format(i))
+            _link(clips['copy'], base + '.mkv')
+            _link(cover, base + '.jpg')
+            _write_info(base + '.info', 'Video {}'.format(i))
+
+    for show in range(shows):
+        show_dir = os.path.join(root, 'TV', 'Show {:02d}'.format(show))
+        _link(cover, os.path.join(show_dir, 'folder.jpg'))
+        for season in range(1, 3):
+            for episode in range(1, 7):
+                name = 'S{:02d}E{:02d}'.format(season, episode)
+                base = os.path.join(show_dir, 'Season {}'.format(season), name)
+                _link(clips['copy'], base + '.mkv')
+                _link(cover, base + '.jpg')
+                _write_info(base + '.info', 'Show {} {}'.format(show, name))
+        os.makedirs(os.path.join(root, 'Latest'), exist_ok=True)
+        os.symlink(os.path.join('..', 'TV', 'Show {:02d}'.format(show), 'Season 2', 'S02E06.mkv'),
+                   os.path.join(root, 'Latest', 'Show {:02d} S02E06.mkv'.format(show)))
+
+    for name, clip in clips.items():
+        # Copied rather than linked, so nothing's already cached against the inode
+        os.makedirs(os.path.join(root, 'Bench', name))
+        shutil.copyfile(clip, os.path.join(root, 'Bench', name, name + '.mkv'))
+
+
+def _summarise(times):
+    return {
+        'runs': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times),
+    }
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def _fetch(client, url, **kwargs):
+    """GET url and read the whole body, since a streamed response is returned as soon as its headers are ready"""
+    resp = client.get(url, **kwargs)
+    resp.get_data()
+    return resp
+
+
+def bench_folders(vfs, client, root, folder_sizes, repeat):
+    results = {}
+    for size in folder_sizes:
+        dirpath = os.path.join('Sized', str(size))
+        fullpath = os.path.join(root, dirpath)
+        cold, warm, ls_cold, ls_warm, ls_revalidate = [], [], [], [], []
+        for _ in range(repeat):
+            # Cold means rescanning the directory & rebuilding every vfs object
+            vfs._library_index.invalidate(fullpath)
+            cold.append(_timed(lambda: list(vfs.Folder(dirpath)))[0])
+            warm.append(_timed(lambda: list(vfs.Folder(dirpath)))[0])
+
+            vfs._library_index.invalidate(fullpath)
+            ls_cold.append(_timed(lambda: _fetch(client, '/browser/{}/ls.json'.format(dirpath)))[0])
+            duration, resp = _timed(lambda: _fetch(client, '/browser/{}/ls.json'.format(dirpath)))
+            ls_warm.append(duration)
+            etag = resp.headers['ETag']
+            duration, resp = _timed(lambda: _fetch(client, '/browser/{}/ls.json'.format(dirpath),
+                                                   headers={'If-None-Match': etag}))
+            assert resp.status_code == 304
+            ls_revalidate.append(duration)
+        results[str(size)] = {
+            'folder_iteration_cold': _summarise(cold),
+            'folder_iteration_warm': _summarise(warm),
+            'ls_json_cold': _summarise(ls_cold),
+            'ls_json_warm': _summarise(ls_warm),
+            'ls_json_304': _summarise(ls_revalidate),
+        }
+    return results
+
+
+def bench_thumbnails(client, dirpath):
+    entries = client.get('/browser/{}/ls.json'.format(dirpath)).get_json()
+    urls = [e['preview'] for e in entries if e['preview']]
+
+    start = time.perf_counter()
+    for url in urls:
+        assert client.get(url).status_code == 200
+    rendered = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for url in urls:
+        client.get(url)
+    cached = time.perf_counter() - start
+
+    return {
+        'count': len(urls),
+        'rendered_per_second': len(urls) / rendered,
+        'cached_per_second': len(urls) / cached,
+    }
+
+
+def bench_hls(transcode, client, root, name):
+    dirpath = os.path.join('Bench', name, name + '.mkv')
+    fileuri = 'file:' + os.path.join(root, dirpath)
+
+    start = time.perf_counter()
+    resp = client.get('/watch/{}/hls-manifest.m3u8'.format(dirpath))
+    time_to_manifest = time.perf_counter() - start
+    assert resp.status_code == 200, resp.data
+    resp = client.get('/watch/{}/hls-segment-0.ts'.format(dirpath))
+    time_to_first_segment = time.perf_counter() - start
+    assert resp.status_code == 200, resp.data
+
+    # Let it finish the rest to see how much faster than realtime it goes
+    session = transcode.get_session(fileuri)
+    while session.running:
+        session.touch()
+        time.sleep(0.1)
+    total = time.perf_counter() - start
+    assert session.complete, "ffmpeg didn't finish transcoding"
+
+    return {
+        'time_to_manifest': time_to_manifest,
+        'time_to_first_segment': time_to_first_segment,
+        'transcode_total': total,
+        'speed_ratio': session.duration / total,
+        'ffmpeg_reported_speed': session.progress.get('speed'),
+    }
+
+
+def bench_captions(ffmpeg, root, name):
+    fileuri = 'file:' + os.path.join(root, 'Bench', name, name + '.mkv')
+    tracks = json.loads(ffmpeg.get_caption_tracks(fileuri))
+    native = [index for index in tracks if index.startswith('native:')]
+    # NOTE: get_caption_tracks() starts extracting them in the background, so this includes waiting on that
+    first, _ = _timed(lambda: ffmpeg.get_captions(fileuri, native[0]))
+    rest, _ = _timed(lambda: [ffmpeg.get_captions(fileuri, index) for index in native[1:]])
+    return {
+        'tracks': len(native),
+        'first_track': first,
+        'remaining_tracks': rest,
+    }
+
+
+def _version_info():
+    info = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        info['git'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=repo_dir,
+                                              stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git'] = None
+    info['ffmpeg'] = subprocess.check_output(['ffmpeg', '-version'], universal_newlines=True).splitlines()[0]
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--library', help="Generate the library here and keep it, rather than in a temporary directory")
+    parser.add_argument('--output', help="Write the results to this file rather than stdout")
+    parser.add_argument('--folder-sizes', default='10,100,1000',
+                        help="Comma separated number of videos per folder (default: %(default)s)")
+    parser.add_argument('--shows', type=int, default=5, help="Number of nested TV shows (default: %(default)s)")
+    parser.add_argument('--duration', type=int, default=60, help="Length in seconds of each video (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5, help="Times to repeat each listing (default: %(default)s)")
+    args = parser.parse_args()
+    folder_sizes = [int(size) for size in args.folder_sizes.split(',')]
+
+    work_dir = tempfile.mkdtemp(prefix='web-emcee-bench.')
+    try:
+        root = os.path.abspath(args.library or os.path.join(work_dir, 'library'))
+        if not os.path.isdir(root):
+            generate_library(root, folder_sizes, args.shows, args.duration)
+
+        os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+        import ffmpeg
+        import main as web_emcee
+        import transcode
+        import vfs
+        vfs._CONFIG_MEDIA_PATH = root
+        web_emcee.media_path = root + '/'
+        client = web_emcee.app.test_client()
+
+        results = _version_info()
+        results['library'] = {'folder_sizes': folder_sizes, 'shows': args.shows, 'duration': args.duration}
+        print("Listing folders", file=sys.stderr)
+        results['folders'] = bench_folders(vfs, client, root, folder_sizes, args.repeat)
+        print("Rendering thumbnails", file=sys.stderr)
+        results['thumbnails'] = bench_thumbnails(client, os.path.join('Sized', str(min(folder_sizes))))
+        results['hls'] = {}
+        results['captions'] = {}
+        for name, _, _ in _SOURCE_CLIPS:
+            print("Streaming", name, file=sys.stderr)
+            results['hls'][name] = bench_hls(transcode, client, root, name)
+            results['captions'][name] = bench_captions(ffmpeg, root, name)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
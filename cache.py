@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+# This is expected to survive reboots, so it lives in the XDG cache dir rather than the runtime dir
+# FIXME: Put this in a config file somehow
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'web-emcee')
+
+
+def media_key(path: str):
+    """Identify the file at path by what it is rather than where it is, for keying caches on.
+
+    That's the (st_dev, st_ino) of wherever the symlinks end up, so every alias of a file gets the same key,
+    plus the size & mtime so nothing stale gets used once the file changes.
+    """
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _disk_usage(path):
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                # Something else removed it while we were looking, so it doesn't count anyway
+                pass
+    return total
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class DiskCache():
+    """Size-bounded on-disk LRU cache with one file, or directory of files, per key.
+
+    The entry's mtime is used as the last-used time so that the LRU order survives restarts.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.path = os.path.join(CACHE_DIR, name)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Least recently used first, maps key -> size in bytes
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        # Entries that are currently in use and must not be evicted, such as a transcode that's still being written
+        self._pinned = collections.Counter()
+
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def __repr__(self):
+        return '<{modname}.{classname} {path!r}>'.format(
+            modname=self.__module__, classname=self.__class__.__name__, path=self.path)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _load(self):
+        found = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(subdir.path):
+                # A .tmp file is leftover from a write that never finished, probably because we crashed.
+                if entry.name.endswith('.tmp') or not self._clean_entry(entry.path):
+                    _remove(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                found.append((st.st_mtime_ns, entry.name, _disk_usage(entry.path)))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def _clean_entry(self, path):
+        """Tidy up anything a crash might have left behind in an entry, returns False if it's not worth keeping"""
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.endswith('.tmp'):
+                        os.remove(os.path.join(dirpath, filename))
+        return True
+
+    @staticmethod
+    def key(*parts):
+        """Turn any number of (repr-able) values into a cache key"""
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def entry_path(self, key: str):
+        # Fan the entries out across 256 subdirectories so no one directory gets too big
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str):
+        """Return the path to the cached entry, or None if there isn't one."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Someone deleted it behind our back
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+            return None
+        return path
+
+    def put(self, key: str, data: bytes):
+        """Atomically store data under key, evicting old entries if needed, and return the entry's path."""
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it into place so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict(keep=key)
+        return path
+
+    def mkdtemp(self, key: str):
+        """Make a temporary directory to build up key's entry in, then hand it to put_dir() once it's complete"""
+        parent = os.path.dirname(self.entry_path(key))
+        os.makedirs(parent, exist_ok=True)
+        # The .tmp suffix gets it cleaned up on the next restart if we crash before it's finished
+        return tempfile.mkdtemp(dir=parent, suffix='.tmp')
+
+    def put_dir(self, key: str, tmp_path: str):
+        """Atomically move a directory from mkdtemp() into place as key's entry, and return the entry's path."""
+        path = self.entry_path(key)
+        # os.replace() can't replace a directory that isn't empty
+        _remove(path)
+        os.replace(tmp_path, path)
+        size = _disk_usage(path)
+
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict(keep=key)
+        return path
+
+    def makedir(self, key: str):
+        """Create (if needed) a directory entry for the caller to fill in, and return its path.
+
+        Call refresh() as it gets filled in so the cache knows how big it's getting.
+        """
+        path = self.entry_path(key)
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = 0
+            self._entries.move_to_end(key)
+        return path
+
+    def refresh(self, key: str):
+        """Recalculate the size of an entry that's been changed in place, evicting others if it's grown too big"""
+        size = _disk_usage(self.entry_path(key))
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes += size - self._entries[key]
+                self._entries[key] = size
+                self._evict(keep=key)
+
+    def pin(self, key: str):
+        with self._lock:
+            self._pinned[key] += 1
+
+    def unpin(self, key: str):
+        with self._lock:
+            self._pinned[key] -= 1
+            if self._pinned[key] <= 0:
+                del self._pinned[key]
+
+    def _evict(self, keep=None):
+        # NOTE: Must be called with self._lock held
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key == keep or self._pinned[key] > 0:
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            _remove(self.entry_path(key))
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""Fetches remote cover images (mostly from IMDB's CDN) once and keeps them locally, so the clients never need to"""
+import collections
+import concurrent.futures
+import http.client
+import io
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import PIL.Image
+
+import cache
+import metrics
+
+# FIXME: Put these in a config file somehow
+_CONFIG_COVER_CACHE_SIZE = 512 * 1024 * 1024  # 512MB
+_CONFIG_COVER_MAX_AGE = 30 * 24 * 60 * 60  # How long (seconds) before checking the remote server for a newer image
+_CONFIG_FETCH_THREADS = 4  # How many images to download at once
+_CONFIG_FETCH_TIMEOUT = 10  # seconds
+_MAX_REDIRECTS = 5
+_MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Anything bigger than this is surely not a cover image
+
+
+class FetchError(Exception):
+    pass
+
+
+class _ConnectionPool():
+    """Keeps HTTP connections open after each request, so fetching a whole folder's covers doesn't reconnect for each"""
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)  # (scheme, netloc) -> [idle connection]
+
+    def _new_connection(self, scheme, netloc):
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(netloc, timeout=self._timeout)
+
+    def _request(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise FetchError("Unsupported URL scheme", url)
+        target = urllib.parse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+
+        with self._lock:
+            idle = self._idle[(parsed.scheme, parsed.netloc)]
+            connection = idle.pop() if idle else None
+        if connection is None:
+            connection = self._new_connection(parsed.scheme, parsed.netloc)
+        else:
+            try:
+                return self._send(connection, parsed, target, url)
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The server got sick of waiting and closed it, so try again on a fresh one
+                connection = self._new_connection(parsed.scheme, parsed.netloc)
+            except (OSError, http.client.HTTPException) as e:
+                raise FetchError(str(e), url) from e
+        try:
+            return self._send(connection, parsed, target, url)
+        except (OSError, http.client.HTTPException) as e:
+            raise FetchError(str(e), url) from e
+
+    def _send(self, connection, parsed, target, url):
+        try:
+            connection.request('GET', target, headers={'User-Agent': 'web-emcee'})
+            response = connection.getresponse()
+            length = response.getheader('Content-Length')
+            if length and int(length) > _MAX_IMAGE_SIZE:
+                raise FetchError("Image too big", url)
+            # Reading it all is needed for the connection to be reusable anyway
+            body = response.read(_MAX_IMAGE_SIZE + 1)
+            if len(body) > _MAX_IMAGE_SIZE:
+                raise FetchError("Image too big", url)
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle[(parsed.scheme, parsed.netloc)].append(connection)
+        return response, body
+
+    def get(self, url):
+        """GET url, following any redirects, and return the body"""
+        for _ in range(_MAX_REDIRECTS + 1):
+            response, body = self._request(url)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                raise FetchError("HTTP {} {}".format(response.status, response.reason), url)
+            return body
+        raise FetchError("Too many redirects", url)
+
+
+_pool = _ConnectionPool(timeout=_CONFIG_FETCH_TIMEOUT)
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_CONFIG_FETCH_THREADS, thread_name_prefix='cover-fetch')
+# Each entry is a directory with the one 'image' file in it.
+# The cache touches the directory whenever it's used, so the image's own mtime is when it was downloaded.
+_cover_cache = cache.DiskCache('covers', max_bytes=_CONFIG_COVER_CACHE_SIZE)
+# url -> Future, so a bunch of clients asking for the same cover at once only download it once
+_downloads = {}
+_downloads_lock = threading.Lock()
+
+
+def _download(url, key):
+    try:
+        body = _pool.get(url)
+        # Some servers answer with an HTML error page rather than an error status, which would be no use cached
+        try:
+            PIL.Image.open(io.BytesIO(body)).verify()
+        except (OSError, SyntaxError, ValueError) as e:
+            raise FetchError("Not an image: {}".format(e), url) from e
+        tmp_path = _cover_cache.mkdtemp(key)
+        with open(os.path.join(tmp_path, 'image'), 'wb') as f:
+            f.write(body)
+        return os.path.join(_cover_cache.put_dir(key, tmp_path), 'image')
+    finally:
+        with _downloads_lock:
+            _downloads.pop(url, None)
+
+
+def fetch(url: str):
+    """Return the path to a local copy of the image at url, downloading it if it's not cached or has expired"""
+    key = _cover_cache.key(url)
+    entry_path = _cover_cache.get(key)
+    image_path = os.path.join(entry_path, 'image') if entry_path else None
+    if image_path and not os.path.isfile(image_path):
+        image_path = None
+    if image_path and time.time() - os.stat(image_path).st_mtime < _CONFIG_COVER_MAX_AGE:
+        metrics.cache_lookups.inc(cache='cover', result='hit')
+        return image_path
+
+    metrics.cache_lookups.inc(cache='cover', result='miss')
+    with _downloads_lock:
+        if url not in _downloads:
+            _downloads[url] = _executor.submit(_download, url, key)
+        download = _downloads[url]
+    try:
+        return download.result(timeout=_CONFIG_FETCH_TIMEOUT * 2)
+    except (FetchError, concurrent.futures.TimeoutError) as e:
+        if image_path:
+            # Better an old cover than none at all, such as when the internet's down
+            print("WARNING: Couldn't refresh cover", url, e, file=sys.stderr)
+            return image_path
+        raise FetchError(str(e), url) from e
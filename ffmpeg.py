@@ -1,67 +1,238 @@
 #!/usr/bin/python3
+import array
+import collections
+import errno
 import glob
 import json
-import multiprocessing
+import math
 import os
-import signal
+import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
 import urllib.parse
 
-import flask
+import cache
+import metrics
 
 # Emby's ffmpeg invocation when watching a movie from Chrome Desktop on Debian:
 #      /opt/emby-server/bin/ffmpeg -f matroska,webm -i file:/srv/media/Video/TV/Stitchers/S03E02.mkv -threads 0 -map 0:0 -map 0:1 -map -0:s -codec:v:0 libx264 -vf scale=trunc(min(max(iw\,ih*dar)\,1920)/2)*2:trunc(ow/dar/2)*2 -pix_fmt yuv420p -preset veryfast -crf 23 -maxrate 4148908 -bufsize 8297816 -profile:v high -level 4.1 -x264opts:0 subme=0:me_range=4:rc_lookahead=10:me=dia:no_chroma_me:8x8dct=0:partitions=none -force_key_frames expr:if(isnan(prev_forced_t),eq(t,t),gte(t,prev_forced_t+3)) -copyts -vsync -1 -codec:a:0 copy -f segment -max_delay 5000000 -avoid_negative_ts disabled -map_metadata -1 -map_chapters -1 -start_at_zero -segment_time 3 -individual_header_trailer 0 -segment_format mpegts -segment_list_type m3u8 -segment_start_number 0 -segment_list /var/lib/emby/transcoding-temp/f435d247a8462ffd19925d38e555451b.m3u8 -y /var/lib/emby/transcoding-temp/f435d247a8462ffd19925d38e555451b%d.ts  # noqa: E501
 
-### FIXME: These are mostly just assumed by grepping ffprobe -formats & -codecs for each of the things mentioned at
-###        https://developers.google.com/cast/docs/media
-###        Also Emby outputs in matroska,webm so I *know* that's supported
-## supported_codecs = {
-##     'container': ['aac', 'mp3', 'mp4', 'wav', 'webm', 'webm_chunk', 'matroska,webm'],
-##     'video': ['h264', 'vp8'],  # Chromecast Ultra also supports ['hevc', 'vp9']
-##     'audio': ['aac', 'flac', 'mp3', 'opus', 'vorbis'],
-## }
+# How long (seconds) each HLS segment is.
+# NOTE: When copying the video codec ffmpeg can only cut on the source's keyframes,
+#       so those segments are instead at least this long, see get_segment_times()
+SEGMENT_LENGTH = 6
 
+# The renditions for the adaptive bitrate profile as (height, video kbit/s), best first.
+# Anything taller than the source gets skipped, since upscaling only wastes bandwidth.
+_ABR_LADDER = [
+    (1080, 5000),
+    (720, 2800),
+    (480, 1200),
+]
+_ABR_AUDIO_BITRATE = 128  # kbit/s
 
-def get_duration(fileuri: str):
-    # FIXME: Can ffmpeg just tell us the duration as it starts up?
+# FIXME: Put this in a config file somehow
+_CONFIG_CAPTIONS_CACHE_SIZE = 256 * 1024 * 1024  # 256MB
+_CONFIG_KEYFRAMES_CACHE_SIZE = 64 * 1024 * 1024  # 64MB, a 2 hour film is typically 20-60KB
+_CONFIG_TRICKPLAY_CACHE_SIZE = 512 * 1024 * 1024  # 512MB, a 2 hour film is typically 1-2MB
+
+# The seek bar previews, one every TRICKPLAY_INTERVAL seconds, tiled into sprite sheets of TRICKPLAY_TILES previews
+TRICKPLAY_INTERVAL = 10
+TRICKPLAY_WIDTH = 160
+TRICKPLAY_TILES = (10, 10)  # columns, rows
+
+# Subtitle codecs ffmpeg can turn into WebVTT, image based ones such as PGS & VobSub can't be.
+_TEXT_SUBTITLE_CODECS = {'subrip', 'srt', 'ass', 'ssa', 'webvtt', 'mov_text', 'text', 'microdvd', 'subviewer', 'sami'}
+
+# What each client can play natively out of the HLS stream, anything else gets transcoded.
+# Since the HLS segments are MPEG-TS this is narrower than what the clients support in general,
+# e.g. Chromecast can play vp8 & opus, but not out of MPEG-TS.
+# FIXME: These are mostly just assumed from https://developers.google.com/cast/docs/media & hls.js's documentation
+_CLIENT_CAPABILITIES = {
+    # hls.js pulls the streams out of the MPEG-TS and hands them to the browser's Media Source Extensions
+    'browser': {
+        'video': {'h264'},
+        'audio': {'aac', 'mp3'},
+        'pix_fmt': {'yuv420p', 'yuvj420p'},  # Nothing plays 10-bit or 4:4:4 h264
+        'h264_level': 52,
+    },
+    'chromecast': {
+        'video': {'h264'},  # Chromecast Ultra also supports hevc
+        'audio': {'aac', 'ac3', 'eac3', 'mp3'},
+        'pix_fmt': {'yuv420p', 'yuvj420p'},
+        'h264_level': 41,  # Non-Ultra Chromecasts only go up to 1080p30
+    },
+}
+
+
+def _can_copy(stream, client: str):
+    capabilities = _CLIENT_CAPABILITIES[client]
+    if stream['codec_name'] not in capabilities[stream['codec_type']]:
+        return False
+    if stream['codec_type'] == 'video':
+        if stream.get('pix_fmt') not in capabilities['pix_fmt']:
+            return False
+        if stream['codec_name'] == 'h264' and stream.get('level', 0) > capabilities['h264_level']:
+            return False
+    return True
+
+
+def _pick_stream(streams, codec_type: str):
+    candidates = [s for s in streams if s.get('codec_type') == codec_type and
+                  # Cover art embedded in the file shows up as a video stream, but isn't one
+                  not s.get('disposition', {}).get('attached_pic')]
+    # FIXME: Pick an audio track by language rather than just whatever the file says the default is
+    for stream in candidates:
+        if stream.get('disposition', {}).get('default'):
+            return stream
+    return candidates[0] if candidates else None
+
+
+def _copies_video(probed_info):
+    video = _pick_stream(probed_info['streams'], 'video')
+    return video is not None and all(_can_copy(video, client) for client in _CLIENT_CAPABILITIES)
+
+
+def _start_offset(probed_info):
+    """The file's first timestamp, which (such as with MPEG-TS) isn't necessarily 0"""
+    return float(probed_info['format'].get('start_time', 0))
+
+
+def _codec_args(probed_info, start_time=0, copyts=True):
+    """Pick one video & one audio stream, and decide whether each can be copied as is or needs transcoding.
+
+    copyts is whether ffmpeg will be keeping the file's own timestamps, which affects where the keyframes get forced.
+    """
+    args = []
+    video = _pick_stream(probed_info['streams'], 'video')
+    audio = _pick_stream(probed_info['streams'], 'audio')
+    # The same HLS output is shared by every client watching, so it has to suit all of them
+    clients = _CLIENT_CAPABILITIES.keys()
+
+    if video is not None:
+        args.extend(('-map', '0:{}'.format(video['index'])))
+        if all(_can_copy(video, client) for client in clients):
+            args.extend(('-codec:v', 'copy'))
+        else:
+            args.extend(('-codec:v', 'libx264', '-pix_fmt', 'yuv420p', '-profile:v', 'high', '-level', '4.1',
+                         # Put a keyframe on every segment boundary, so every segment is exactly as long as the manifest says.
+                         # NOTE: When the timestamps are copied across, t starts at start_time plus the file's own
+                         #       start offset, not 0.
+                         '-force_key_frames', 'expr:gte(t,{start}+n_forced*{length})'.format(
+                             start=start_time + (_start_offset(probed_info) if copyts else 0), length=SEGMENT_LENGTH)))
+    if audio is not None:
+        args.extend(('-map', '0:{}'.format(audio['index'])))
+        if all(_can_copy(audio, client) for client in clients):
+            args.extend(('-codec:a', 'copy'))
+        else:
+            # FIXME: Keep 5.1 audio as 5.1 when the client can handle it
+            args.extend(('-codec:a', 'aac', '-ac', '2'))
+    return args
+
+
+class _ProbeCache():
+    """Persistent cache of ffprobe results, keyed on the file's device & inode.
+
+    The size & mtime are stored alongside so that a changed file is simply reprobed.
+    Everything is also kept in memory, so a cache hit costs no more than a stat() call.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # NOTE: Flask is running threaded, so I'm sharing the one connection with a lock around it.
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS probe ('
+                         'dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, info TEXT, '
+                         'PRIMARY KEY (dev, ino))')
+        self._memory = {(dev, ino): (size, mtime, json.loads(info)) for dev, ino, size, mtime, info in
+                        self._db.execute('SELECT dev, ino, size, mtime, info FROM probe')}
+        # One lock per file so that a bunch of requests for the same file only trigger one ffprobe
+        self._probe_locks = collections.defaultdict(threading.Lock)
+
+    def get(self, path):
+        dev, ino, size, mtime = cache.media_key(path)
+        key = (dev, ino)
+        cached = self._memory.get(key)
+        if cached and cached[:2] == (size, mtime):
+            metrics.cache_lookups.inc(cache='probe', result='hit')
+            return cached[2]
+
+        metrics.cache_lookups.inc(cache='probe', result='miss')
+        with self._probe_locks[key]:
+            # Someone else might've probed it while we were waiting for the lock
+            cached = self._memory.get(key)
+            if cached and cached[:2] == (size, mtime):
+                return cached[2]
+
+            info = _run_ffprobe('file:' + path)
+            self._memory[key] = (size, mtime, info)
+            with self._db_lock:
+                self._db.execute('INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?)',
+                                 (dev, ino, size, mtime, json.dumps(info)))
+        return info
+
+
+def _run_ffprobe(fileuri: str):
     # FIXME: Add a reasonable timeout. What's reasonable?
-    # FIXME: Technically each track within the media file can have a different duration.
     probe = subprocess.check_output(
         stdin=subprocess.DEVNULL, universal_newlines=True, args=[
             'ffprobe', '-loglevel', 'error',
-            '-show_entries', 'format=duration',
+            '-show_format', '-show_streams',
             '-print_format', 'json=compact=1',
             '-i', fileuri])
     probed_info = json.loads(probe)
     assert "format" in probed_info
+    assert "streams" in probed_info
+    return probed_info
+
+
+_probe_cache = _ProbeCache(os.path.join(cache.CACHE_DIR, 'probe.sqlite'))
+
+
+def probe(fileuri: str):
+    """Get the ffprobe format & stream info for a media file, only actually running ffprobe the first time"""
+    parseduri = urllib.parse.urlparse(fileuri)
+    if parseduri.scheme in ('', 'file'):
+        return _probe_cache.get(parseduri.path)
+    else:
+        # Can't stat a remote file, so can't know when it's changed, so don't cache it.
+        metrics.cache_lookups.inc(cache='probe', result='miss')
+        return _run_ffprobe(fileuri)
+
+
+def get_duration(fileuri: str):
+    # FIXME: Technically each track within the media file can have a different duration.
+    probed_info = probe(fileuri)
     assert "duration" in probed_info["format"]
-    assert len(probed_info.keys()) == 1
-    assert len(probed_info["format"].keys()) == 1
     return float(probed_info["format"]["duration"])
 
 
 def get_caption_tracks(fileuri: str):
     caption_tracks = {}
 
-    probe = subprocess.check_output(
-        stdin=subprocess.DEVNULL, universal_newlines=True, args=[
-            'ffprobe', '-loglevel', 'error', '-print_format', 'json',
-            fileuri, '-select_streams', 's',
-            '-show_entries', 'stream=index:stream_tags'])
-    probed_info = json.loads(probe)
-    assert "streams" in probed_info
-    for track in probed_info["streams"]:
-        if "language" not in track["tags"]:
-            track["tags"]["language"] = "und"
-            if "title" not in track["tags"]:
-                track["tags"]["title"] = "Undetermined"
-        if "title" not in track["tags"]:
-            track["tags"]["title"] = track["tags"]["language"].title()  # FIXME: Make a better title
-        caption_tracks["native:{}".format(track["index"])] = track["tags"]
+    for stream in probe(fileuri)["streams"]:
+        if stream.get("codec_type") != "subtitle":
+            continue
+        # Copy it so I'm not messing with the cached probe info
+        tags = dict(stream.get("tags", {}))
+        if "language" not in tags:
+            tags["language"] = "und"
+            if "title" not in tags:
+                tags["title"] = "Undetermined"
+        if "title" not in tags:
+            tags["title"] = tags["language"].title()  # FIXME: Make a better title
+        caption_tracks["native:{}".format(stream["index"])] = tags
 
     parseduri = urllib.parse.urlparse(fileuri)
     if parseduri.scheme in ('', 'file'):
+        if caption_tracks:
+            # The browser's going to ask for the captions next, so get started on pulling them all out of the file
+            threading.Thread(target=_warm_captions, args=(parseduri.path,), name='captions', daemon=True).start()
+
         # Find every file with just a different extension
         for ind, sub_file in enumerate(glob.glob("{}.*".format(parseduri.path.rpartition(os.path.extsep)[0]))):
             ext = sub_file.rpartition(os.path.extsep)[-1]
@@ -74,109 +245,589 @@ def get_caption_tracks(fileuri: str):
     return json.dumps(caption_tracks)
 
 
+_captions_cache = cache.DiskCache('captions', _CONFIG_CAPTIONS_CACHE_SIZE)
+# One lock per file so that the browser asking for every track at once only triggers the one ffmpeg
+_captions_locks = collections.defaultdict(threading.Lock)
+
+
+def _extract_captions(path: str, key: str):
+    """Convert every text subtitle stream in path to WebVTT, all in the one pass over the file.
+
+    Each stream ends up as '{stream index}.vtt' in the returned cache entry directory.
+    """
+    streams = [stream["index"] for stream in probe('file:' + path)["streams"]
+               if stream.get("codec_type") == "subtitle" and stream.get("codec_name") in _TEXT_SUBTITLE_CODECS]
+    output_args = []
+    for stream_id in streams:
+        output_args.extend((
+            '-map', '0:{}'.format(stream_id),
+            '-codec:s', 'webvtt', '-f', 'webvtt',  # WebVTT is all that's supported, so no need to get smart here
+            '{}.vtt'.format(stream_id)))
+
+    tmp_path = _captions_cache.mkdtemp(key)
+    try:
+        if output_args:
+            subprocess.run(
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                check=True, cwd=tmp_path, args=[
+                    'ffmpeg', '-loglevel', 'error', '-nostdin',
+                    '-i', 'file:' + path,  # Everything after this only applies to the outputs
+                    *output_args])
+    except BaseException as e:
+        if isinstance(e, subprocess.CalledProcessError):
+            print(e.stderr, file=sys.stderr)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return _captions_cache.put_dir(key, tmp_path)
+
+
+def _get_captions_dir(path: str):
+    key = _captions_cache.key(*cache.media_key(path))
+    entry_path = _captions_cache.get(key)
+    if entry_path is None:
+        with _captions_locks[key]:
+            # Someone else might've extracted them while we were waiting for the lock
+            entry_path = _captions_cache.get(key)
+            if entry_path is None:
+                entry_path = _extract_captions(path, key)
+    return entry_path
+
+
+def _warm_captions(path: str):
+    try:
+        _get_captions_dir(path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("WARNING: Couldn't extract captions from", path, e, file=sys.stderr)
+
+
 def get_captions(fileuri: str, index: str):
-    input_type, stream_id = index.split(':', 1)
+    """Return the path to a WebVTT file for the caption track index, as listed by get_caption_tracks()"""
+    # FIXME: Only works for local files
+    path = urllib.parse.urlparse(fileuri).path
+    input_type, _, stream_id = index.partition(':')
     if input_type == 'supplementary':
-        fileuri = os.path.extsep.join((fileuri.rpartition(os.path.extsep)[0], stream_id))
-        stream_map = 's'
-    elif input_type == "native":
-        # FIXME: Understand this better
-        #        I think the '0:' means "the first file" or similar.
-        #        I think if I were using larger mpeg-ts streams (like DVB-T) it would get more complicated.
-        stream_map = "0:{}".format(stream_id)
-
-    # FIXME: In all my testing, ffmpeg did this job really quick,
-    #        but perhaps I should turn this into a generator so as to not assume that will be the case.
+        path = os.path.extsep.join((path.rpartition(os.path.extsep)[0], stream_id))
+        # ffmpeg treats a sidecar .srt/.vtt as a file with just the one subtitle stream
+        stream_id = '0'
+    elif input_type != 'native':
+        raise FileNotFoundError(errno.ENOENT, "No such caption track", index)
+    # Don't let the stream id wander off elsewhere in the filesystem
+    if not stream_id.isdigit():
+        raise FileNotFoundError(errno.ENOENT, "No such caption track", index)
+
+    vtt_path = os.path.join(_get_captions_dir(path), '{}.vtt'.format(stream_id))
+    if not os.path.isfile(vtt_path):
+        # Either there's no such stream, or it's an image based subtitle format that can't be turned into WebVTT
+        raise FileNotFoundError(errno.ENOENT, "No such caption track", index)
+    return vtt_path
+
+
+# (name, key) -> Thread, so however many requests ask at once each bit of background work only gets started the once
+_background = {}
+_background_lock = threading.Lock()
+
+
+def _in_background(name: str, key: str, target, *args):
+    """Run target(*args) on its own thread, unless that's already being done for key"""
+    def run():
+        try:
+            target(*args)
+        finally:
+            with _background_lock:
+                _background.pop((name, key), None)
+
+    with _background_lock:
+        if (name, key) in _background:
+            return
+        thread = _background[(name, key)] = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+
+
+_keyframes_cache = cache.DiskCache('keyframes', _CONFIG_KEYFRAMES_CACHE_SIZE)
+# One lock per file so only the one ffprobe ever scans it at a time
+_keyframes_locks = collections.defaultdict(threading.Lock)
+
+
+def _scan_keyframes(path: str, key: str):
+    """Go through every packet of the video stream (without decoding any of them) to find where the keyframes are.
+
+    They're stored as a flat array of doubles, in seconds from the start of the file.
+    """
+    probed_info = probe('file:' + path)
+    video = _pick_stream(probed_info['streams'], 'video')
+    output = subprocess.check_output(
+        stdin=subprocess.DEVNULL, universal_newlines=True, args=[
+            # This reads the entire file, so keep out of the way of anything else going on
+            'nice', '-n', '19', 'ionice', '-c', '3',
+            'ffprobe', '-loglevel', 'error',
+            '-select_streams', str(video['index']),
+            '-show_entries', 'packet=pts_time,flags',
+            '-print_format', 'csv=print_section=0',
+            '-i', 'file:' + path])
+    # The timestamps are as in the file, which doesn't necessarily start at 0
+    offset = _start_offset(probed_info)
+    keyframes = array.array('d', sorted(
+        float(pts_time) - offset for pts_time, _, flags in (line.partition(',') for line in output.splitlines())
+        if 'K' in flags and pts_time not in ('', 'N/A')))
+    _keyframes_cache.put(key, keyframes.tobytes())
+    return keyframes
+
+
+def _load_keyframes(entry_path: str):
+    keyframes = array.array('d')
+    with open(entry_path, 'rb') as f:
+        keyframes.frombytes(f.read())
+    return keyframes
+
+
+def _get_keyframes(path: str, key: str):
+    entry_path = _keyframes_cache.get(key)
+    if entry_path is None:
+        with _keyframes_locks[key]:
+            # Someone else might've scanned it while we were waiting for the lock
+            entry_path = _keyframes_cache.get(key)
+            if entry_path is None:
+                return _scan_keyframes(path, key)
+    return _load_keyframes(entry_path)
+
+
+def _warm_keyframes(path: str, key: str):
     try:
-        vtt_result = subprocess.check_output(
-            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
-            args=[
+        _get_keyframes(path, key)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("WARNING: Couldn't scan keyframes of", path, e, file=sys.stderr)
+
+
+def get_keyframes(fileuri: str, wait=True):
+    """Get the timestamps (seconds) of every keyframe in fileuri's video stream, as a sorted array of floats.
+
+    Finding them means reading the whole file, so if wait is False this returns None if that's not been done yet,
+    and starts doing it in the background.
+    Also returns None if there's no video stream or it's not a local file.
+    """
+    parseduri = urllib.parse.urlparse(fileuri)
+    if parseduri.scheme not in ('', 'file') or _pick_stream(probe(fileuri)['streams'], 'video') is None:
+        return None
+    key = _keyframes_cache.key(*cache.media_key(parseduri.path))
+    if wait:
+        return _get_keyframes(parseduri.path, key)
+
+    entry_path = _keyframes_cache.get(key)
+    if entry_path is not None:
+        return _load_keyframes(entry_path)
+    _in_background('keyframes', key, _warm_keyframes, parseduri.path, key)
+    return None
+
+
+def keyframes_pending(fileuri: str, profile='default'):
+    """Whether get_segment_times() would cut fileuri differently once its keyframes are known, see get_keyframes()"""
+    parseduri = urllib.parse.urlparse(fileuri)
+    if profile != 'default' or parseduri.scheme not in ('', 'file') or not _copies_video(probe(fileuri)):
+        return False
+    return _keyframes_cache.get(_keyframes_cache.key(*cache.media_key(parseduri.path))) is None
+
+
+def get_segment_times(fileuri: str, profile='default', use_keyframes=True):
+    """Where each HLS segment starts (seconds), plus where the last one ends, so there's one more than there's segments.
+
+    When the video is being copied the segments can only start on a keyframe, so if the keyframes are known each
+    segment starts on the first one at least SEGMENT_LENGTH after the last segment started.
+    Otherwise, or if that's not known yet (see get_keyframes()), it's just every SEGMENT_LENGTH seconds.
+    """
+    duration = get_duration(fileuri)
+    keyframes = None
+    # The other profiles always transcode the video, so the keyframes go wherever the segments need them
+    if profile == 'default' and use_keyframes and _copies_video(probe(fileuri)):
+        keyframes = get_keyframes(fileuri, wait=False)
+
+    if keyframes:
+        times = [0]
+        for keyframe in keyframes:
+            if keyframe >= times[-1] + SEGMENT_LENGTH and keyframe < duration:
+                times.append(keyframe)
+    else:
+        times = [index * SEGMENT_LENGTH for index in range(math.ceil(duration / SEGMENT_LENGTH))]
+    times.append(duration)
+    return times
+
+
+_trickplay_cache = cache.DiskCache('trickplay', _CONFIG_TRICKPLAY_CACHE_SIZE)
+# One lock per file so only the one ffmpeg ever generates them at a time
+_trickplay_locks = collections.defaultdict(threading.Lock)
+
+
+def _trickplay_height(video):
+    """How tall each preview is once scaled down to TRICKPLAY_WIDTH, keeping the aspect ratio it's displayed at"""
+    sar_num, _, sar_den = video.get('sample_aspect_ratio', '1:1').partition(':')
+    try:
+        sar = int(sar_num) / int(sar_den)
+    except (ValueError, ZeroDivisionError):
+        # ffprobe says 0:1 when it doesn't know
+        sar = 1
+    if sar <= 0:
+        sar = 1
+    # libjpeg & friends don't like odd dimensions
+    return max(2, round(TRICKPLAY_WIDTH * video['height'] / (video['width'] * sar) / 2) * 2)
+
+
+def _trickplay_vtt(duration: float, height: int, sheets: int):
+    """A WebVTT track with a cue for each preview, pointing at where it is in which sprite sheet"""
+    columns, rows = TRICKPLAY_TILES
+    cues = ['WEBVTT', '']
+    for index in range(min(math.ceil(duration / TRICKPLAY_INTERVAL), sheets * columns * rows)):
+        sheet, tile = divmod(index, columns * rows)
+        row, column = divmod(tile, columns)
+        start = index * TRICKPLAY_INTERVAL
+        end = min(start + TRICKPLAY_INTERVAL, duration)
+        cues.append('{} --> {}'.format(*('{:02d}:{:02d}:{:06.3f}'.format(
+            int(t // 3600), int(t // 60 % 60), t % 60) for t in (start, end))))
+        # Relative to thumbnails.vtt, so the browser asks for it from alongside that
+        cues.append('trickplay-{}.jpg#xywh={},{},{},{}'.format(
+            sheet, column * TRICKPLAY_WIDTH, row * height, TRICKPLAY_WIDTH, height))
+        cues.append('')
+    return '\n'.join(cues)
+
+
+def _generate_trickplay(path: str, key: str):
+    """Pull the previews out of path in one pass, only decoding the keyframes and scaling them down as they come.
+
+    The cache entry directory ends up with the sprite sheets as 'trickplay-{n}.jpg', and 'thumbnails.vtt' to go with them.
+    """
+    probed_info = probe('file:' + path)
+    video = _pick_stream(probed_info['streams'], 'video')
+    duration = float(probed_info['format']['duration'])
+    height = _trickplay_height(video)
+
+    tmp_path = _trickplay_cache.mkdtemp(key)
+    try:
+        subprocess.run(
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True, cwd=tmp_path, args=[
+                # This reads the entire file, so keep out of the way of anything else going on
+                'nice', '-n', '19', 'ionice', '-c', '3',
                 'ffmpeg', '-loglevel', 'error', '-nostdin',
-                '-i', fileuri,  # Everything after this only applies to the output
-                '-codec:s', 'webvtt', '-f', 'webvtt',  # WebVTT is all that's supported, so no need to get smart here
-                '-map', stream_map,
-                'pipe:1'])
-    except subprocess.CalledProcessError as e:
-        err = e.stderr.strip()
-        if (err.endswith('No such file or directory') or
-            'matches no streams.' in err):
-                return e.stderr, 404
-        else:
+                # Decoding only the keyframes is far quicker, and they're close enough for a preview.
+                # NOTE: This must come before the -i it applies to
+                '-skip_frame', 'nokey',
+                '-i', 'file:' + path,  # Everything after this only applies to the outputs
+                '-map', '0:{}'.format(video['index']),
+                # The fps filter repeats/drops whichever keyframes are needed to get exactly one every TRICKPLAY_INTERVAL
+                '-vf', 'fps=1/{interval},scale={width}:{height},tile={columns}x{rows}'.format(
+                    interval=TRICKPLAY_INTERVAL, width=TRICKPLAY_WIDTH, height=height,
+                    columns=TRICKPLAY_TILES[0], rows=TRICKPLAY_TILES[1]),
+                '-q:v', '5',
+                '-f', 'image2', '-start_number', '0', 'trickplay-%d.jpg'])
+        sheets = len(glob.glob(os.path.join(tmp_path, 'trickplay-*.jpg')))
+        with open(os.path.join(tmp_path, 'thumbnails.vtt'), 'w') as f:
+            f.write(_trickplay_vtt(duration, height, sheets))
+    except BaseException as e:
+        if isinstance(e, subprocess.CalledProcessError):
             print(e.stderr, file=sys.stderr)
-            raise
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return _trickplay_cache.put_dir(key, tmp_path)
+
+
+def _get_trickplay_dir(path: str, key: str):
+    entry_path = _trickplay_cache.get(key)
+    if entry_path is None:
+        with _trickplay_locks[key]:
+            # Someone else might've generated them while we were waiting for the lock
+            entry_path = _trickplay_cache.get(key)
+            if entry_path is None:
+                entry_path = _generate_trickplay(path, key)
+    return entry_path
+
+
+def _warm_trickplay(path: str, key: str):
+    try:
+        _get_trickplay_dir(path, key)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("WARNING: Couldn't generate seek previews of", path, e, file=sys.stderr)
+
+
+def get_trickplay(fileuri: str, filename='thumbnails.vtt', wait=True):
+    """Return the path to one of the seek bar preview files, either 'thumbnails.vtt' or a sprite sheet it points at.
+
+    Generating them means reading the whole file, so if wait is False this returns None if that's not been done yet,
+    and starts doing it in the background.
+    Raises FileNotFoundError if there's no video stream or it's not a local file.
+    """
+    parseduri = urllib.parse.urlparse(fileuri)
+    if parseduri.scheme not in ('', 'file') or _pick_stream(probe(fileuri)['streams'], 'video') is None:
+        raise FileNotFoundError(errno.ENOENT, "No seek previews for", fileuri)
+    # The layout's in the key too, so changing any of it doesn't leave the old ones around with the wrong cues
+    key = _trickplay_cache.key(*cache.media_key(parseduri.path),
+                               TRICKPLAY_INTERVAL, TRICKPLAY_WIDTH, TRICKPLAY_TILES)
+    entry_path = _trickplay_cache.get(key)
+    metrics.cache_lookups.inc(cache='trickplay', result='miss' if entry_path is None else 'hit')
+    if entry_path is None:
+        if wait:
+            entry_path = _get_trickplay_dir(parseduri.path, key)
+        else:
+            _in_background('trickplay', key, _warm_trickplay, parseduri.path, key)
+            return None
+
+    file_path = os.path.join(entry_path, filename)
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError(errno.ENOENT, "No such seek preview", filename)
+    return file_path
+
+
+def get_renditions(probed_info):
+    """Work out the adaptive bitrate ladder for a file, there's none if it's got no video"""
+    video = _pick_stream(probed_info['streams'], 'video')
+    if video is None:
+        return []
+    audio = _pick_stream(probed_info['streams'], 'audio')
+    # avc1.640029 is h264 High@4.1, mp4a.40.2 is AAC-LC, as per _abr_codec_args()
+    codecs = 'avc1.640029' if audio is None else 'avc1.640029,mp4a.40.2'
+    ladder = [(height, bitrate) for height, bitrate in _ABR_LADDER if height <= video['height']]
+    if not ladder:
+        # Smaller than even the lowest rung, so just don't scale it at all
+        ladder = [(video['height'], _ABR_LADDER[-1][1])]
+
+    return [{
+        # Same as what scale=-2:height will come up with
+        'width': int(round(video['width'] * height / video['height'] / 2)) * 2,
+        'height': height,
+        'video_bitrate': bitrate,
+        'bandwidth': (bitrate + (0 if audio is None else _ABR_AUDIO_BITRATE)) * 1000,
+        'codecs': codecs,
+    } for height, bitrate in ladder]
+
+
+def _abr_codec_args(probed_info, start_time=0):
+    """Decode once, then split & scale that into each of the renditions in get_renditions()"""
+    renditions = get_renditions(probed_info)
+    video = _pick_stream(probed_info['streams'], 'video')
+    audio = _pick_stream(probed_info['streams'], 'audio')
+
+    filters = ['[0:{index}]split={count}{outputs}'.format(
+        index=video['index'], count=len(renditions),
+        outputs=''.join('[split{}]'.format(i) for i in range(len(renditions))))]
+    filters.extend('[split{i}]scale=-2:{height}[scaled{i}]'.format(i=i, height=r['height']) for i, r in enumerate(renditions))
+    args = ['-filter_complex', ';'.join(filters)]
+
+    stream_map = []
+    for i, rendition in enumerate(renditions):
+        args.extend(('-map', '[scaled{}]'.format(i)))
+        args.extend(('-b:v:{}'.format(i), '{}k'.format(rendition['video_bitrate']),
+                     '-maxrate:v:{}'.format(i), '{}k'.format(rendition['video_bitrate']),
+                     '-bufsize:v:{}'.format(i), '{}k'.format(rendition['video_bitrate'] * 2)))
+        if audio is not None:
+            # Every rendition needs its own copy of the audio, otherwise hls.js can't switch between them cleanly
+            args.extend(('-map', '0:{}'.format(audio['index'])))
+            stream_map.append('v:{i},a:{i}'.format(i=i))
+        else:
+            stream_map.append('v:{i}'.format(i=i))
+    args.extend(('-codec:v', 'libx264', '-pix_fmt', 'yuv420p', '-profile:v', 'high', '-level', '4.1',
+                 # Keyframes on the segment boundaries in every rendition, so they can be switched between at any segment.
+                 # NOTE: As in _codec_args(), t includes the file's own start offset.
+                 '-force_key_frames', 'expr:gte(t,{start}+n_forced*{length})'.format(
+                     start=start_time + _start_offset(probed_info), length=SEGMENT_LENGTH)))
+    if audio is not None:
+        args.extend(('-codec:a', 'aac', '-ac', '2', '-b:a', '{}k'.format(_ABR_AUDIO_BITRATE)))
+    args.extend(('-var_stream_map', ' '.join(stream_map)))
+    return args
+
+
+def segment_filename(index: int, variant=None):
+    # NOTE: Must match the patterns given to ffmpeg in start_transcode()
+    if variant is None:
+        return 'hls-segment-{index:d}.ts'.format(index=index)
     else:
-        return vtt_result
+        return 'hls-v{variant:d}-segment-{index:d}.ts'.format(variant=variant, index=index)
 
 
-def _wait_for_manifest(output_dir: str):
-    # FIXME: I should probably at least put a time.sleep(0.1) here
-    # FIXME: Wait for a couple of segments rather than just wait for the manifest.
-    #        Does ffmpeg perhaps do that already?
-    while not os.path.isfile(os.path.join(output_dir, 'hls-manifest.m3u8')):
-        pass
+# The 'single_file' profile puts every fMP4 segment in the one file, with the playlist giving byte ranges into it.
+SINGLE_FILE = 'hls-stream.mp4'
+SINGLE_FILE_MANIFEST = 'ffmpeg-manifest.m3u8'
 
 
-def start_transcode(output_dir: str, fileuri: str):
+def start_transcode(output_dir: str, fileuri: str, start_segment=0, profile='default',
+                    background_threads=None, segment_limit=None, segment_times=None):
+    """Start ffmpeg transcoding fileuri into HLS segments, from start_segment onwards.
+
+    Only the segments are of any use, the manifest is generated up front by the caller from segment_times,
+    which defaults to get_segment_times().
+    Each segment of the 'default' profile is written to a .tmp file, and ffmpeg sends its filename down the
+    returned process' segment_list once it's complete, see read_segment_list().
+    The 'abr' profile produces every rendition from get_renditions() in the one ffmpeg.
+    The 'single_file' profile instead writes fMP4 segments into SINGLE_FILE, and its manifest is the one ffmpeg writes.
+    That can't be resumed part way through, so it always starts from the beginning.
+    If background_threads is set, ffmpeg is limited to that many threads and run at idle CPU & IO priority.
+    If segment_limit is set, ffmpeg stops after that many segments.
+    """
     # FIXME: Is it even worth doing HLS if this is how we have to do it?
-    # FIXME: Perhaps just turn this into an iterable generator of a single mp4/ts stream and do streaming "old-school"
+    #        See start_stream() for streaming a single mp4 "old-school" instead.
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
+    if segment_times is None:
+        segment_times = get_segment_times(fileuri, profile)
+    probed_info = probe(fileuri)
+    start_time = segment_times[start_segment]
+    if profile == 'default':
+        # This also ignores the subtitles, since those are handled separately
+        codec_args = _codec_args(probed_info, start_time)
+        # I would like to 0-pad the number, but I don't know how far to pad it
+        segment_pattern, manifest_pattern = 'hls-segment-%d.ts', 'ffmpeg-manifest.m3u8'
+    elif profile == 'abr':
+        codec_args = _abr_codec_args(probed_info, start_time)
+        segment_pattern, manifest_pattern = 'hls-v%v-segment-%d.ts', 'ffmpeg-manifest-%v.m3u8'
+    elif profile == 'single_file':
+        assert start_segment == 0, "A single file transcode can only start from the beginning"
+        codec_args = _codec_args(probed_info)
+        segment_pattern, manifest_pattern = SINGLE_FILE, SINGLE_FILE_MANIFEST
+        # Don't want anyone reading a manifest left over from an earlier run that never finished
+        for filename in (SINGLE_FILE, SINGLE_FILE_MANIFEST):
+            if os.path.exists(os.path.join(output_dir, filename)):
+                os.remove(os.path.join(output_dir, filename))
+    else:
+        raise ValueError("Unknown transcode profile {!r}".format(profile))
+
+    seek_time = start_time
+    if start_segment and profile == 'default' and _copies_video(probed_info):
+        # The input seek lands on the keyframe at or before -ss, so nudge it forward a touch
+        # in case rounding the keyframe's timestamp put it just before, otherwise that'd be a whole GOP early.
+        seek_time += 0.001
+
+    list_fds = None
+    if profile == 'default':
+        # Everything's given in the file's own timestamps, since they're copied across as is
+        offset = _start_offset(probed_info)
+        list_fds = os.pipe()
+        output_args = [
+            # The segment muxer (rather than hls) since it can be told exactly where to cut.
+            # Either these are keyframes already, or -force_key_frames above made them keyframes.
+            '-f', 'segment', '-segment_format', 'mpegts',
+            '-segment_start_number', str(start_segment),
+            '-segment_times', ','.join('{:.6f}'.format(t + offset) for t in segment_times[start_segment + 1:]),
+            '-segment_time_delta', '0.001',
+            # ffmpeg only adds each segment to the list once it's finished with it,
+            # so that's when it gets renamed into place and hls-segment-N.ts is safe to send.
+            '-segment_list', 'pipe:{:d}'.format(list_fds[1]), '-segment_list_type', 'flat',
+            segment_pattern + '.tmp']
+    elif profile == 'single_file':
+        output_args = [
+            '-f', 'hls', '-hls_time', str(SEGMENT_LENGTH), '-hls_list_size', '0',
+            # fMP4 has less overhead per segment than MPEG-TS, and with single_file it's also just the one file,
+            # rather than thousands of tiny ones for a film.
+            '-hls_segment_type', 'fmp4', '-hls_flags', 'single_file',
+            # ffmpeg's manifest gets served as is, growing as it goes until it's finished
+            '-hls_playlist_type', 'event',
+            '-hls_segment_filename', segment_pattern,
+            manifest_pattern]
+    else:
+        output_args = [
+            '-f', 'hls', '-hls_time', str(SEGMENT_LENGTH), '-hls_list_size', '0',
+            '-start_number', str(start_segment),
+            # Write each segment to a .tmp file and only rename it into place once it's complete,
+            # so if hls-segment-N.ts exists it's safe to send.
+            '-hls_flags', 'temp_file',
+            '-hls_segment_filename', segment_pattern,
+            # This isn't the manifest the clients get, so it's named differently to avoid confusion
+            manifest_pattern]
+
+    priority_args = []
+    if background_threads:
+        # Both nice & ionice exec the next command, so this is still the ffmpeg process as far as Popen is concerned
+        priority_args = ['nice', '-n', '19', 'ionice', '-c', '3']
+        codec_args.extend(('-threads', str(background_threads)))
+    input_args = []
+    if segment_limit:
+        end_segment = min(start_segment + segment_limit, len(segment_times) - 1)
+        input_args = ['-t', '{:.6f}'.format(segment_times[end_segment] - seek_time)]
+
     # Not using run() because I don't want to wait around for ffmpeg to finish,
     # annoyingly that means I don't get check=True and have to sort out my own returncode handling, if any.
-    # FIXME: Implement some sort of cleanup so we don't keep transcoding if the user goes away.
-    ffmpeg = subprocess.Popen(
-        stdin=subprocess.DEVNULL, universal_newlines=True,
-        cwd=output_dir, args=[
+    # NOTE: Stopping ffmpeg when the user goes away is up to the caller, see transcode.Session
+    try:
+        process = subprocess.Popen(
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True,
+            pass_fds=list_fds[1:] if list_fds else (), cwd=output_dir, args=[
+                *priority_args,
+                'ffmpeg', '-loglevel', 'error', '-nostdin',
+                '-progress', 'pipe:1',  # See read_progress()
+                # Seeking on the input side is much quicker since ffmpeg can skip straight there without decoding everything first
+                '-ss', '{:.6f}'.format(seek_time), *input_args,
+                '-i', fileuri,  # Everything after this only applies to the output
+                *codec_args,
+                # Keep the original timestamps, so the segments line up with each other no matter which run of ffmpeg made them
+                '-copyts', '-avoid_negative_ts', 'disabled',
+                *output_args])
+    except BaseException:
+        if list_fds:
+            os.close(list_fds[0])
+        raise
+    finally:
+        # Only ffmpeg should have the writing end open, so the reader sees EOF when it exits
+        if list_fds:
+            os.close(list_fds[1])
+    process.segment_list = open(list_fds[0], encoding='utf-8') if list_fds else None
+    return process
+
+
+def start_stream(fileuri: str, start_time=0):
+    """Start ffmpeg transcoding fileuri into a single fragmented mp4 on its stdout, from start_time seconds onwards.
+
+    Nothing touches the disk, and the first fragment can be sent as soon as ffmpeg has produced it.
+    """
+    # NOTE: Stopping ffmpeg when the user goes away is up to the caller, see transcode.stream()
+    return subprocess.Popen(
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        args=[
             'ffmpeg', '-loglevel', 'error', '-nostdin',
+            '-ss', str(start_time),
             '-i', fileuri,  # Everything after this only applies to the output
-            '-map', 'v', '-map', 'a',  # FIXME: Only grab one of each. For now this is just me making sure to ignore the subs
-            '-codec:a', 'libmp3lame', '-codec:v', 'libx264',  # FIXME: Copy the codec when it's already supported
-            '-f', 'hls', '-hls_playlist_type', 'vod',
-            '-hls_segment_filename', 'hls-segment-%d.ts',  # I would like to 0-pad the number, but I don't know how far to pad it
-            # FIXME: Did ffmpeg remove the temp_file flag?
-            # # With Emby I was seeing instances of what looked like the browser caching ahead of what the server had transcoded
-            # # I suspect that's because Emby wasn't using this temp_file flag, but I've not been able to confirm that in any way.
-            # '-hls_flags', 'temp_file',
-            # FIXME: Add the single_file flag?
-            'hls-manifest.m3u8'])
-    timer = multiprocessing.Process(target=_wait_for_manifest, args=(output_dir,))
-    timer.start()
-    # FIXME: I don't think I'm waiting long enough, not sure, but this has had false negatives at times.
-    timer.join(timeout=5)  # Wait for process to end or 5 seconds, whichever comes first.
-
-    if ffmpeg.poll():
-        # I know there's subprocess.run().check_returncode() but Popen doesn't have similar, so I gotta do it myself.
-        #
-        # I'm only defining this variable instead of putting it all on the raise line so that the backtrace looks nicer
-        err = ffmpeg.stderr.read().decode()
-        print(err, file=sys.stderr, flush=True)
-        FfmpegError = subprocess.CalledProcessError(
-            returncode=ffmpeg.returncode,
-            cmd=ffmpeg.args,
-            # output=ffmpeg.stdout.read(),  # I've already captured the stdout, so this is useless.
-            stderr=err,
-        )
-        raise FfmpegError
-
-    if timer.is_alive():  # Shit, we timed out without finding a manifest
-        # Cleanup the timer, and ffmpeg
-        timer.terminate()
-        # ffmpeg doesn't acknowledge a SIGTERM, but it does die on SIGINT
-        ffmpeg.send_signal(signal.SIGINT)
-        # If that didn't work, SIGKILL it
-        try: ffmpeg.wait(timeout=2)                      # noqa: E701
-        except subprocess.TimeoutExpired: ffmpeg.kill()  # noqa: E701
-
-        raise FileNotFoundError('No manifest file was found after ffmpeg initialisation')
-
-
-def get_manifest(output_dir: str, fileuri: str):
-    if not os.path.isfile(os.path.join(output_dir, 'hls-manifest.m3u8')):
-        start_transcode(output_dir, fileuri)
-
-    return flask.send_from_directory(output_dir, 'hls-manifest.m3u8', mimetype='application/x-mpegURL')
-
-
-def get_segment(output_dir: str, index: int):
-    return flask.send_from_directory(output_dir, 'hls-segment-{index:d}.ts'.format(index=index), mimetype='video/mp2t')
+            # Without -copyts the output starts at 0 regardless of where it was seeked to, so the keyframes should too
+            *_codec_args(probe(fileuri), copyts=False),
+            '-f', 'mp4',
+            # A normal mp4 needs seeking back to the start to write the index once it's finished, which a pipe can't do.
+            # Fragmented mp4 instead puts an empty index up front and then a self-contained fragment every keyframe.
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            'pipe:1'])
+
+
+_encode_speed = metrics.Histogram(
+    'webemcee_ffmpeg_speed', "ffmpeg's reported encoding speed, as a multiple of realtime",
+    buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 4, 8, 16, 32))
+_encode_fps = metrics.Histogram(
+    'webemcee_ffmpeg_fps', "ffmpeg's reported encoding frames per second",
+    buckets=(5, 10, 24, 30, 50, 60, 120, 240, 480, 960))
+
+
+def _record_progress(progress):
+    # Either of these can be 'N/A', such as before the first frame or when there's no video
+    try: _encode_speed.observe(float(progress.get('speed', '').rstrip('x')))  # noqa: E701
+    except ValueError: pass                                                   # noqa: E701
+    try: _encode_fps.observe(float(progress.get('fps', '')))                  # noqa: E701
+    except ValueError: pass                                                   # noqa: E701
+
+
+def read_segment_list(process: subprocess.Popen):
+    """Yield the filename of each segment as ffmpeg finishes it, until it exits.
+
+    NOTE: Once ffmpeg's been told to stop it finishes off whatever segment it was part way through,
+          and lists that too even though it'll be cut short.
+    """
+    with process.segment_list:
+        for line in process.segment_list:
+            if line.strip():
+                yield os.path.basename(line.strip())
+
+
+def read_progress(process: subprocess.Popen):
+    """Yield a dict of ffmpeg's '-progress pipe:1' output each time it reports in, until it exits"""
+    progress = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        progress[key] = value
+        # 'progress' is always the last key of each report, and is set to 'end' on the last one
+        if key == 'progress':
+            if value == 'continue':
+                # The final report is an average over the whole run, which would count that twice
+                _record_progress(progress)
+            yield progress
+            progress = {}
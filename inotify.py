@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""Just enough of Linux's inotify API for watching directories, via ctypes so there's nothing extra to install"""
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# From <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+Event = collections.namedtuple('Event', ('wd', 'mask', 'cookie', 'name'))
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _check(ret, path=None):
+    if ret == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return ret
+
+
+class Inotify():
+    def __init__(self):
+        self.fd = _check(_libc.inotify_init1(IN_CLOEXEC))
+
+    def __repr__(self):
+        return '<{modname}.{classname} fd={fd}>'.format(
+            modname=self.__module__, classname=self.__class__.__name__, fd=self.fd)
+
+    def add_watch(self, path: str, mask: int):
+        """Start watching path, returns the watch descriptor that events for it will be tagged with"""
+        return _check(_libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask)), path)
+
+    def rm_watch(self, wd: int):
+        try:
+            _check(_libc.inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            # The kernel has already removed it, probably because the directory was deleted
+            if e.errno != errno.EINVAL:
+                raise
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for events, and return a list of them"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
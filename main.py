@@ -1,29 +1,42 @@
 #!/usr/bin/python3
+import argparse
 import errno
+import itertools
 import json
 import os
 import sys
+import threading
+import time
+import urllib.parse
 
 import flask
+import werkzeug.security
 
+import covers
 import ffmpeg
 
+import metrics
+import transcode
 import vfs
 
 app = flask.Flask("web-emcee")
 
-# NOTE: This temporary directory is not secure because it's predictable,
-#       but I'm only intending to use it for transcoding cache, so that's ok.
-# FIXME: Clear this cache on startup
-TMP_DIR = os.path.join(os.environ.get('XDG_RUNTIME_DIR', os.environ.get('TMPDIR', '/tmp/')), app.name)
+_request_latency = metrics.Histogram('webemcee_request_duration_seconds',
+                                     "Time taken to respond to each request, up until the body starts being sent",
+                                     ('route', 'status'))
 
-media_path = sys.argv[1] if len(sys.argv) > 1 else os.path.curdir
-media_path += '/' if not media_path.endswith('/') else ''
+# NOTE: Replaced by the command line argument when run directly
+media_path = os.path.curdir + '/'
 
 
 def get_mediauri(filename):
-    filepath = os.path.join(os.path.abspath(media_path), filename)
-    if not os.path.exists(filepath) or os.path.isdir(filepath):
+    try:
+        # Every alias of a file (such as Latest/Foo-S01E01 -> TV/Foo/S01E01) comes out as the same path,
+        # so the transcodes, captions, etc. all get shared between them.
+        filepath, _, is_dir = vfs.resolve(os.path.join(os.path.abspath(media_path), filename))
+    except FileNotFoundError:
+        is_dir = True
+    if is_dir:
         # Technically this is invalid for "isdir", but good enough.
         raise FileNotFoundError(errno.ENOENT, "No such media file", filename)
     fileuri = 'file:' + filepath
@@ -33,26 +46,118 @@ def get_mediauri(filename):
     return fileuri
 
 
+def send_file(path, **kwargs):
+    """Same as flask.send_file(), but makes sure byte range responses can use the server's sendfile() too."""
+    resp = flask.send_file(path, conditional=True, **kwargs)
+    file_wrapper = flask.request.environ.get('wsgi.file_wrapper')
+    if resp.status_code == 206 and file_wrapper is not None:
+        # Werkzeug sends a range by reading it through Python a chunk at a time.
+        # A server that provides wsgi.file_wrapper (such as gunicorn) will instead sendfile() Content-Length bytes
+        # from wherever the file is currently positioned, so hand it one that's been seeked to the start of the range.
+        start = resp.content_range.start
+        resp.close()
+        f = open(path, 'rb')
+        f.seek(start)
+        resp.response = file_wrapper(f)
+    return resp
+
+
 @app.route('/')
 def index():
     return "Front page not designed yet"
 
 
-@app.route('/browser/ls.json', defaults={'dirpath': ''})
-@app.route('/browser/<path:dirpath>/ls.json')
-def listdir(dirpath):
-    entries = [{
+def _listing_entry(e):
+    if isinstance(e, vfs.Folder):
+        # Finding a folder's preview means listing that folder too, so leave that until the browser actually asks for it
+        x, y = vfs.THUMBNAIL_SIZE
+        preview = '/folder-preview/{x}x{y}/{path}'.format(x=x, y=y, path=urllib.parse.quote(e.path))
+    else:
+        preview = e.preview.get_thumbnail() if e.preview else None
+    return {
         'is_file': isinstance(e, vfs.File),
         'mimetype': e.mimetype,
         'name': e.name,
         'path': e.path,
         'sortkey': e.sortkey,
-        'preview': e.preview.get_thumbnail() if e.preview else None,
-    } for e in vfs.Folder(dirpath)]
+        'preview': preview,
+    }
 
-    json_str = json.dumps(entries)
 
-    return json_str
+# Query parameters, all optional:
+#   format=ndjson   One JSON object per line instead of a JSON array, so the client can parse them as they arrive
+#   limit=N         Only this many entries, with a 'Link: <...>; rel="next"' header pointing at the rest
+#   after=CURSOR    Start after this entry, as given in the Link header (it's really just the JSON sortkey)
+@app.route('/browser/ls.json', defaults={'dirpath': ''})
+@app.route('/browser/<path:dirpath>/ls.json')
+def listdir(dirpath):
+    folder = vfs.Folder(dirpath)
+    etag = folder.etag
+    if flask.request.if_none_match.contains(etag):
+        # Nothing's changed since the browser last asked, so don't bother building it all again
+        resp = flask.Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    ndjson = flask.request.args.get('format') == 'ndjson'
+    limit = flask.request.args.get('limit', type=int)
+    after = flask.request.args.get('after')
+    if after is not None:
+        try:
+            is_file, name = json.loads(after)
+        except ValueError:
+            return "Invalid cursor", 400
+        if not (isinstance(is_file, bool) and isinstance(name, str)):
+            return "Invalid cursor", 400
+        after = (is_file, name)
+
+    # The entries get built (and their previews looked up) in parallel, but still come out in order
+    entries = folder.map(_listing_entry, after=after)
+    next_link = None
+    if limit is not None and limit > 0:
+        # Need to know whether there's any more before the headers can go out, but it's only one page's worth
+        entries = list(itertools.islice(entries, limit + 1))
+        if len(entries) > limit:
+            entries = entries[:limit]
+            args = {'after': json.dumps(entries[-1]['sortkey']), 'limit': limit}
+            if ndjson:
+                args['format'] = 'ndjson'
+            next_link = '<ls.json?{}>; rel="next"'.format(urllib.parse.urlencode(args))
+
+    # Each entry gets sent as soon as it's ready, rather than waiting on the whole folder
+    def generate():
+        if ndjson:
+            for entry in entries:
+                yield json.dumps(entry) + '\n'
+        else:
+            separator = ''
+            yield '['
+            for entry in entries:
+                yield separator + json.dumps(entry)
+                separator = ', '
+            yield ']'
+
+    resp = flask.Response(generate(), mimetype='application/x-ndjson' if ndjson else 'application/json')
+    if next_link:
+        resp.headers['Link'] = next_link
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# Query parameters:
+#   q=WORDS   What to look for, in the names of folders & videos and in their .info files
+#   limit=N   At most this many results, best matches first (default 50)
+# Entries are the same as ls.json's, except without the previews since those would mean going to the filesystem.
+@app.route('/search.json')
+def search():
+    query = flask.request.args.get('q', '')
+    limit = flask.request.args.get('limit', 50, type=int)
+    if not 0 < limit <= 500:
+        return "Invalid limit", 400
+    resp = flask.Response(json.dumps(vfs.search_library(query, limit=limit)), mimetype='application/json')
+    resp.cache_control.no_cache = True
+    return resp
 
 
 # NOTE: The trailing '/' is important!
@@ -63,6 +168,71 @@ def browser(dirpath):
     return flask.send_from_directory('static', 'browser.html', mimetype='text/html')
 
 
+# NOTE: ls.json puts the source file's mtime in the query string, so the URL changes whenever the image does.
+#       That makes it safe to tell the browser to cache these forever.
+@app.route('/thumb/<int:width>x<int:height>/<path:path>')
+def thumbnail(width, height, path):
+    if os.path.pardir in path.split('/'):
+        return "Invalid path", 404
+    if not (0 < width <= 1920 and 0 < height <= 1920):
+        return "Invalid thumbnail size", 400
+
+    try:
+        image = vfs.Image(path)
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+
+    resp = send_file(image.get_thumbnail_file(size=(width, height)), mimetype='image/png',
+                     max_age=365 * 24 * 60 * 60)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+# Redirects to the folder's actual preview thumbnail, see _listing_entry()
+@app.route('/folder-preview/<int:width>x<int:height>/<path:path>')
+def folder_preview(width, height, path):
+    if os.path.pardir in path.split('/'):
+        return "Invalid path", 404
+    if not (0 < width <= 1920 and 0 < height <= 1920):
+        return "Invalid thumbnail size", 400
+
+    try:
+        folder = vfs.Folder(path)
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+    if folder.preview is None:
+        return "No preview", 404
+
+    resp = flask.redirect(folder.preview.get_thumbnail(size=(width, height)))
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# Remote cover images, fetched & thumbnailed by the server so the clients don't need to go out to the CDN themselves.
+# The path is the .info file that has the cover's URL in it.
+@app.route('/cover/<int:width>x<int:height>/<path:path>')
+def cover(width, height, path):
+    if os.path.pardir in path.split('/') or not path.endswith('.info'):
+        return "Invalid path", 404
+    if not (0 < width <= 1920 and 0 < height <= 1920):
+        return "Invalid thumbnail size", 400
+
+    try:
+        image = vfs.get_cover(path)
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+    try:
+        thumbnail_path = image.get_thumbnail_file(size=(width, height))
+    except covers.FetchError as e:
+        return "Couldn't fetch cover: {}".format(e), 502
+
+    # NOTE: Unlike /thumb/ the remote image can change without the URL changing, so this can't be cached forever.
+    resp = send_file(thumbnail_path, mimetype='image/png', max_age=24 * 60 * 60)
+    resp.cache_control.public = True
+    return resp
+
+
 @app.route('/watch/<path:filename>')
 def watch(filename):
     try:
@@ -77,9 +247,15 @@ def watch(filename):
 def get_captions(filename):
     fileuri = get_mediauri(filename)
 
-    resp = flask.make_response(ffmpeg.get_captions(fileuri, flask.request.args.get('index')))
+    try:
+        vtt_path = ffmpeg.get_captions(fileuri, flask.request.args.get('index', ''))
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+
     # Must return vtt regardless of input type
-    resp.mimetype = 'text/vtt'
+    # NOTE: send_file() sorts out the ETag & Last-Modified so the browser can revalidate with a cheap 304
+    resp = send_file(vtt_path, mimetype='text/vtt')
+    resp.cache_control.no_cache = True
     return resp
 
 
@@ -92,12 +268,65 @@ def get_caption_tracks(filename):
     return resp
 
 
+@app.route('/watch/<path:filename>/thumbnails.vtt')
+def trickplay_vtt(filename):
+    fileuri = get_mediauri(filename)
+
+    try:
+        vtt_path = ffmpeg.get_trickplay(fileuri, wait=False)
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+    if vtt_path is None:
+        # It takes a good while to go through the whole file, so come back later rather than tying up this worker
+        resp = flask.make_response("Seek previews not generated yet", 503)
+        resp.retry_after = 30
+        return resp
+
+    resp = send_file(vtt_path, mimetype='text/vtt')
+    resp.cache_control.no_cache = True
+    return resp
+
+
+@app.route('/watch/<path:filename>/trickplay-<int:index>.jpg')
+def trickplay_sprite(filename, index):
+    fileuri = get_mediauri(filename)
+
+    try:
+        sprite_path = ffmpeg.get_trickplay(fileuri, 'trickplay-{}.jpg'.format(index), wait=False)
+    except FileNotFoundError as e:
+        return ' '.join((e.strerror, e.filename)), 404
+    if sprite_path is None:
+        return "Seek previews not generated yet", 404
+
+    resp = send_file(sprite_path, mimetype='image/jpeg')
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def _warm_next_video(filename):
+    """Get the next episode ready in the background, since that's most likely what gets watched next"""
+    try:
+        next_video = vfs.get_next_video(filename)
+    except Exception as e:
+        # Not worth breaking playback of this one over
+        print("WARNING: Couldn't find the video after", filename, e, file=sys.stderr)
+        return
+    if next_video is not None:
+        transcode.schedule(next_video.local_uri, priority=transcode.PRIORITY_NEXT_EPISODE)
+
+
+def _warm_new_arrival(fullpath, mimetype):
+    if mimetype.startswith('video/'):
+        transcode.schedule('file:' + fullpath, priority=transcode.PRIORITY_NEW_ARRIVAL)
+
+
 @app.route('/watch/<path:filename>/hls-manifest.m3u8')
 def manifest(filename):
     fileuri = get_mediauri(filename)
-    output_dir = os.path.join(TMP_DIR, os.path.basename(fileuri))  # FIXME: foo/S01E02 and bar/S01E02 will conflict
+    # Finding it means listing the whole folder, which shouldn't hold up playing this one
+    threading.Thread(target=_warm_next_video, args=(filename,), name='warm-next-video', daemon=True).start()
 
-    resp = flask.make_response(ffmpeg.get_manifest(output_dir, fileuri))
+    resp = flask.make_response(transcode.get_manifest(fileuri))
     resp.cache_control.no_cache = True
     return resp
 
@@ -105,9 +334,80 @@ def manifest(filename):
 @app.route('/watch/<path:filename>/hls-segment-<int:index>.ts')
 def hls_segment(filename, index):
     fileuri = get_mediauri(filename)
-    output_dir = os.path.join(TMP_DIR, os.path.basename(fileuri))  # FIXME: foo/S01E02 and bar/S01E02 will conflict
 
-    return ffmpeg.get_segment(output_dir, index)
+    return transcode.get_segment(fileuri, index)
+
+
+# An alternative to HLS for clients that can just play a plain old video file.
+# Seeking means starting a new request with ?start=<seconds>
+@app.route('/watch/<path:filename>/stream.mp4')
+def stream(filename):
+    fileuri = get_mediauri(filename)
+    start_time = max(flask.request.args.get('start', 0, type=float), 0)
+
+    if flask.request.method == 'HEAD':
+        # Not worth starting ffmpeg just for it to be thrown away
+        resp = flask.Response(mimetype='video/mp4')
+        resp.cache_control.no_store = True
+        return resp
+    resp = transcode.stream(fileuri, start_time)
+    resp.cache_control.no_store = True
+    return resp
+
+
+@app.route('/watch/<path:filename>/hls-single.m3u8')
+def single_file_manifest(filename):
+    fileuri = get_mediauri(filename)
+
+    resp = flask.make_response(transcode.get_single_file_manifest(fileuri))
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# Every segment of the single_file profile is a byte range of this, see send_file() for how those get served
+@app.route('/watch/<path:filename>/hls-stream.mp4')
+def single_file(filename):
+    fileuri = get_mediauri(filename)
+
+    path = transcode.get_single_file(fileuri)
+    if not os.path.isfile(path):
+        return "Not transcoded yet", 404
+    resp = send_file(path, mimetype='video/mp4')
+    # It keeps growing until ffmpeg's done with it
+    resp.cache_control.no_cache = True
+    return resp
+
+
+@app.route('/watch/<path:filename>/hls-master.m3u8')
+def master_manifest(filename):
+    fileuri = get_mediauri(filename)
+
+    resp = flask.make_response(transcode.get_master_manifest(fileuri))
+    resp.cache_control.no_cache = True
+    return resp
+
+
+@app.route('/watch/<path:filename>/hls-v<int:variant>.m3u8')
+def variant_manifest(filename, variant):
+    fileuri = get_mediauri(filename)
+
+    resp = flask.make_response(transcode.get_variant_manifest(fileuri, variant))
+    resp.cache_control.no_cache = True
+    return resp
+
+
+@app.route('/watch/<path:filename>/hls-v<int:variant>-segment-<int:index>.ts')
+def variant_segment(filename, variant, index):
+    fileuri = get_mediauri(filename)
+
+    return transcode.get_segment(fileuri, index, variant)
+
+
+@app.errorhandler(transcode.TooManyTranscodes)
+def too_many_transcodes(e):
+    resp = flask.make_response(str(e), 503)
+    resp.retry_after = 30
+    return resp
 
 
 @app.route('/watch/<path:filename>/duration')
@@ -120,7 +420,33 @@ def duration(filename):
 
 @app.route('/raw_media/<path:filename>')
 def raw_media(filename):
-    return flask.send_from_directory(media_path, filename)
+    # Accepts Range requests, so the browser can seek around without downloading the whole thing first
+    path = werkzeug.security.safe_join(media_path, filename)
+    if path is None or not os.path.isfile(path):
+        return "No such media file", 404
+    return send_file(path)
+
+
+@app.route('/metrics')
+def get_metrics():
+    resp = flask.make_response(metrics.render())
+    resp.content_type = metrics.CONTENT_TYPE
+    return resp
+
+
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+app.before_request(start_request_timer)  # noqa: E305
+
+
+# NOTE: For streamed responses (segments, stream.mp4, etc) this is only the time until the headers are ready.
+def record_request_latency(response):
+    if 'request_start' in flask.g:
+        # Using the endpoint (function name) rather than the URL, so every file doesn't get its own label
+        _request_latency.observe(time.perf_counter() - flask.g.request_start,
+                                 route=flask.request.endpoint or 'unknown', status=response.status_code)
+    return response
+app.after_request(record_request_latency)  # noqa: E305
 
 
 # Chromecast requires CORS headers for all media resources, I don't yet understand CORS headers.
@@ -147,7 +473,60 @@ def get_ip():
     return flask.request.access_route[0]
 
 
+def start_background_tasks():
+    vfs.add_new_file_listener(_warm_new_arrival)
+    vfs.start_library_index()
+
+
+def run_production(bind: str, threads: int, max_connections: int):
+    """Serve with gunicorn, which sendfile()s file responses straight from the kernel rather than through Python"""
+    try:
+        import gunicorn.app.base
+    except ImportError:
+        sys.exit("--production requires gunicorn, try 'apt install gunicorn' or 'pip install gunicorn'")
+
+    class Application(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            # NOTE: Only the one worker process, because the transcode sessions & caches are all kept in memory.
+            #       Transcoding happens in ffmpeg anyway, so the GIL isn't what's holding things back.
+            for key, value in {
+                'bind': bind,
+                'workers': 1,
+                'worker_class': 'gthread',
+                'threads': threads,  # How many requests can be handled at once
+                'worker_connections': max_connections,  # Any more than this and the listen queue starts filling up
+                'sendfile': True,
+                # Threads started before the fork don't exist in the worker, so start them in there.
+                'post_worker_init': lambda worker: start_background_tasks(),
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
 if __name__ == "__main__":
-    if not os.path.isdir(TMP_DIR):
-        os.mkdir(TMP_DIR)
-    app.run(debug=True, host='0.0.0.0', threaded=True)
+    parser = argparse.ArgumentParser(description="Web based media browser & streamer")
+    parser.add_argument('media_path', nargs='?', default=os.path.curdir)
+    parser.add_argument('--production', action='store_true',
+                        help="Serve with gunicorn instead of Flask's debugging server")
+    parser.add_argument('--bind', default='0.0.0.0:5000', help="Address to listen on when using --production")
+    # NOTE: A request for a segment that's still being transcoded holds onto its thread until the segment's ready
+    parser.add_argument('--threads', type=int, default=16, help="Requests to handle at once when using --production")
+    parser.add_argument('--max-connections', type=int, default=64,
+                        help="Client connections to accept at once when using --production")
+    args = parser.parse_args()
+
+    media_path = args.media_path
+    media_path += '/' if not media_path.endswith('/') else ''
+
+    if args.production:
+        run_production(args.bind, args.threads, args.max_connections)
+    else:
+        # The debug reloader runs this whole script twice, once to watch for changes & again to actually serve requests.
+        # Only the one serving requests needs them, otherwise two of everything would be fighting over the same caches.
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_tasks()
+        app.run(debug=True, host='0.0.0.0', threaded=True)
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""Just enough of Prometheus' metric types & text format for a /metrics endpoint, so there's nothing extra to install"""
+import threading
+import time
+
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, suits anything from a cached lookup up to waiting on ffmpeg for a segment
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric():
+    _type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # tuple of label values -> value
+        _registry.append(self)
+
+    def __repr__(self):
+        return '<{modname}.{classname} {name!r}>'.format(
+            modname=self.__module__, classname=self.__class__.__name__, name=self.name)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} needs labels {}, got {}".format(self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation.replace('\\', r'\\').replace('\n', r'\n')),
+            '# TYPE {} {}'.format(self.name, self._type),
+        ]
+        for name, labelvalues, extra, value in self._samples():
+            lines.append('{}{} {}'.format(name, _format_labels(self.labelnames, labelvalues, extra), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    _type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up & down.
+
+    If function is given it gets called on every scrape instead, and should return the value,
+    or a dict of {tuple of label values: value} if there's labels.
+    """
+    _type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        values = self._function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, key, (), value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    _type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # [count per bucket (not cumulative), sum]
+                self._values[key] = [[0] * len(self.buckets), 0]
+            counts = self._values[key][0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key][1] += value
+
+    def time(self, **labels):
+        """Context manager that observes how long the with block took"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key, [('le', _format_value(bound))], cumulative))
+                samples.append((self.name + '_sum', key, (), total))
+                samples.append((self.name + '_count', key, (), cumulative))
+        return samples
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+def render():
+    """Everything in the registry in Prometheus' text format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Shared by everything that has some sort of cache, labelled with which cache & whether it was a 'hit' or 'miss'
+cache_lookups = Counter('webemcee_cache_lookups_total', "Cache lookups", ('cache', 'result'))
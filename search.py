@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""In-memory trigram index for finding things by name, so a search never has to go near the filesystem"""
+import heapq
+import itertools
+import re
+import threading
+import unicodedata
+
+_NOT_ALPHANUMERIC = re.compile(r'[\W_]+')
+
+
+def normalise(text: str):
+    """Lowercase, strip accents, and turn punctuation into spaces, so "Amélie" & "amelie!" are the same thing"""
+    text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return _NOT_ALPHANUMERIC.sub(' ', text.casefold()).strip()
+
+
+def _grams(text):
+    """Every trigram in each word, plus the start of each word so that 1 & 2 letter searches still work"""
+    grams = set()
+    for word in text.split():
+        word = ' ' + word
+        grams.add(word[:2])
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def _query_grams(word):
+    # Words shorter than a trigram can only be found at the start of a word
+    if len(word) < 3:
+        return {' ' + word}
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def _matches(word, text):
+    if len(word) < 3:
+        return (' ' + word) in (' ' + text)
+    return word in text
+
+
+class Index():
+    """Documents are added & replaced a group at a time, such as everything in one directory.
+
+    Each document is a name (which counts for more), some other text to match on, a sortkey, and whatever the result
+    should be when it's found.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # gram -> set of doc ids, kept separately for the names so that the best matches can be found on their own
+        self._name_postings = {}
+        self._other_postings = {}
+        self._docs = {}  # doc id -> (name, other text, sortkey, result)
+        self._groups = {}  # group -> [doc id]
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def groups(self):
+        with self._lock:
+            return list(self._groups)
+
+    def replace_group(self, group, docs):
+        """Replace everything in group with docs, an iterable of (name, other text, sortkey, result)"""
+        # Do all the string mangling before taking the lock, so searches aren't kept waiting on it
+        new_docs = []
+        for name, other, sortkey, result in docs:
+            name, other = normalise(name), normalise(other)
+            new_docs.append(((name, other, sortkey, result), _grams(name), _grams(other)))
+
+        with self._lock:
+            self._remove_group(group)
+            ids = []
+            for doc, name_grams, other_grams in new_docs:
+                doc_id = next(self._ids)
+                self._docs[doc_id] = doc
+                for gram in name_grams:
+                    self._name_postings.setdefault(gram, set()).add(doc_id)
+                for gram in other_grams:
+                    self._other_postings.setdefault(gram, set()).add(doc_id)
+                ids.append(doc_id)
+            if ids:
+                self._groups[group] = ids
+
+    def remove_group(self, group):
+        with self._lock:
+            self._remove_group(group)
+
+    def _remove_group(self, group):
+        for doc_id in self._groups.pop(group, ()):
+            name, other, _, _ = self._docs.pop(doc_id)
+            for postings, text in ((self._name_postings, name), (self._other_postings, other)):
+                for gram in _grams(text):
+                    postings[gram].discard(doc_id)
+                    if not postings[gram]:
+                        del postings[gram]
+
+    def _candidates(self, grams, names_only):
+        # Intersecting the smallest sets first keeps this quick even when some of the words are really common
+        if names_only:
+            postings = [self._name_postings.get(gram, set()) for gram in grams]
+        else:
+            postings = [self._name_postings.get(gram, set()) | self._other_postings.get(gram, set()) for gram in grams]
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for ids in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(ids)
+        return candidates
+
+    def search(self, query: str, limit=50):
+        """Results for everything with every word of query somewhere in it, best matches first"""
+        words = normalise(query).split()
+        if not words:
+            return []
+        grams = set().union(*(_query_grams(word) for word in words))
+        # Short words only have the one gram, which is an exact match already
+        long_words = [word for word in words if len(word) >= 3]
+
+        def rank(doc_id):
+            name, _, sortkey, _ = self._docs[doc_id]
+            # Ones that start with what's being searched for come first
+            return (not name.startswith(words[0]), sortkey)
+
+        with self._lock:
+            # The trigrams can all be there without the words being, so check each candidate properly
+            found = [doc_id for doc_id in self._candidates(grams, names_only=True)
+                     if all(word in self._docs[doc_id][0] for word in long_words)]
+            best = heapq.nsmallest(limit, found, key=rank)
+            if len(best) < limit:
+                # Not enough matches on the names alone, so make up the rest from those that match the other text
+                found = set(found)
+                others = [doc_id for doc_id in self._candidates(grams, names_only=False) if doc_id not in found and
+                          all(_matches(word, self._docs[doc_id][0] + ' ' + self._docs[doc_id][1]) for word in words)]
+                best.extend(heapq.nsmallest(limit - len(best), others, key=rank))
+            return [self._docs[doc_id][3] for doc_id in best]
@@ -1,73 +1,103 @@
-function update_dir_listing() {
-    // FIXME: Render the HTML as a Flask template and do all this in HTML, not JS
-    var req = new XMLHttpRequest();
-    req.open("GET", "ls.json", true);
-    req.onload = function(e) {
-        entries = JSON.parse(req.responseText);
-        full_list = document.getElementById("directory-listing");
-        if (Object.keys(entries).length == 0) {
-            item = document.createElement('li');
-            item.innerText = "Directory is empty";
-            full_list.appendChild(item);
-        } else {
-            current_heading = null;
-            current_list = null;
-            for (var entry_index in entries) {
-                var entry = entries[entry_index];
-                if (entry.is_file & ! entry.mimetype.startsWith('video/')) {
-                    // Don't show any files that are not videos
-                    continue
-                }
+var current_heading = null;
+var current_list = null;
+var entry_count = 0;
 
-                first_letter = entry.sortkey[1][0].toUpperCase()
-                if (!isNaN(parseFloat(first_letter)) && isFinite(first_letter)) {  // Basically, is it a digit?
-                    first_letter = '#'  // FIXME: Will collide with actual '#'
-                }
-                // FIXME: What about punctuation and other non-alphanumeric characters?
-                if (current_heading != first_letter) {
-                    current_list = document.createElement('ol');
-                    current_list.classList.add('single-letter');
-                    current_list.setAttribute('data-letter', first_letter);
-                    current_list.setAttribute('name', first_letter);
-                    full_list.appendChild(current_list);
+function add_entry(entry) {
+    full_list = document.getElementById("directory-listing");
+    if (entry.is_file & ! entry.mimetype.startsWith('video/')) {
+        // Don't show any files that are not videos
+        return
+    }
+    entry_count += 1;
 
-//                    lh = document.createElement('lh');
-//                    lh.innerText = first_letter;
-//                    current_list.appendChild(lh);
-                    current_heading = first_letter;
-                }
+    first_letter = entry.sortkey[1][0].toUpperCase()
+    if (!isNaN(parseFloat(first_letter)) && isFinite(first_letter)) {  // Basically, is it a digit?
+        first_letter = '#'  // FIXME: Will collide with actual '#'
+    }
+    // FIXME: What about punctuation and other non-alphanumeric characters?
+    if (current_heading != first_letter) {
+        current_list = document.createElement('ol');
+        current_list.classList.add('single-letter');
+        current_list.setAttribute('data-letter', first_letter);
+        current_list.setAttribute('name', first_letter);
+        full_list.appendChild(current_list);
 
-                list_item = document.createElement('li');
-                link = document.createElement('a');
-                link.setAttribute('data-filename', entry.name);
-                list_item.appendChild(link);
+//        lh = document.createElement('lh');
+//        lh.innerText = first_letter;
+//        current_list.appendChild(lh);
+        current_heading = first_letter;
+    }
 
-                if (entry.preview) {
-                    img = document.createElement('img');
-                    img.src = entry.preview;
-                    img.alt = entry.name;
-                    link.appendChild(img);
-                } else {
-                    link.innerText = entry.name;
-                }
-                list_item.classList.add('entry');
-                if (entry.is_file) {
-                    link.href = '/watch/' + entry.path;
-                    list_item.classList.add('file');
-                } else {
-                    // entry.path is relative to the media root directory,
-                    // I think entry.name will always be just the filename but I'm not certain
-                    link.href = entry.name;
-                    list_item.classList.add('directory');
-                }
+    let list_item = document.createElement('li');
+    let link = document.createElement('a');
+    link.setAttribute('data-filename', entry.name);
+    list_item.appendChild(link);
 
-                current_list.appendChild(list_item);
-            }
+    if (entry.preview) {
+        let img = document.createElement('img');
+        // Don't bother fetching thumbnails until they're scrolled into view
+        img.loading = 'lazy';
+        img.src = entry.preview;
+        img.alt = entry.name;
+        // Folders always get a preview URL since it's not known whether they have one until it's asked for
+        img.onerror = function() {
+            img.remove();
+            link.innerText = entry.name;
         }
-        document.getElementById('loading').remove();
+        link.appendChild(img);
+    } else {
+        link.innerText = entry.name;
     }
-    req.send();
+    list_item.classList.add('entry');
+    if (entry.is_file) {
+        link.href = '/watch/' + entry.path;
+        list_item.classList.add('file');
+    } else {
+        // entry.path is relative to the media root directory,
+        // I think entry.name will always be just the filename but I'm not certain
+        link.href = entry.name;
+        list_item.classList.add('directory');
+    }
+
+    current_list.appendChild(list_item);
+}
 
+function finish_dir_listing() {
+    if (entry_count == 0) {
+        item = document.createElement('li');
+        item.innerText = "Directory is empty";
+        document.getElementById("directory-listing").appendChild(item);
+    }
+    document.getElementById('loading').remove();
+}
+
+async function update_dir_listing() {
+    // FIXME: Render the HTML as a Flask template and do all this in HTML, not JS
+    // Asking for one entry per line so that each one can be shown as soon as it arrives,
+    // rather than waiting on the whole directory.
+    let response = await fetch("ls.json?format=ndjson");
+    let reader = response.body.getReader();
+    let decoder = new TextDecoder();
+    let buffered = '';
+    while (true) {
+        let {done, value} = await reader.read();
+        if (done) {
+            break;
+        }
+        buffered += decoder.decode(value, {stream: true});
+        let lines = buffered.split('\n');
+        // The last one is either empty or only part of an entry, so keep it for next time
+        buffered = lines.pop();
+        for (let line of lines) {
+            if (line) {
+                add_entry(JSON.parse(line));
+            }
+        }
+    }
+    if (buffered) {
+        add_entry(JSON.parse(buffered));
+    }
+    finish_dir_listing();
 }
 
 window.addEventListener("load", update_dir_listing);
@@ -70,51 +70,13 @@ function secondsToString(seconds) {
     return h+":"+m+":"+s
 }
 
-function _videoSeekBeyondDuration(time, unpause) {
-    if (time >= video_player.total_duration) {
-        console.log("Seeking beyond end of file, I don't know how to deal with this yet");
-    } else {
-        // Jump to the specified time regardless of the current duration to keep the buffer going.
-        video_player.currentTime = time;
-        if (time > video_player.duration) {
-            // FIXME: I don't like overwriting the event functions,
-            // but it's the easiest way I could find that lets me clear it without knowing the response from addEventListener
-            if (video_player.ondurationchange == null || video_player.ondurationchange == undefined) {
-                video_player.ondurationchange = function(ev) {
-                    // FIXME: Wait, time and unpause shouldn't be set in this context... why does this work?
-                    //        I think I just don't understand JS contexts
-                    _videoSeekBeyondDuration(time, unpause)
-                };
-            };
-        } else {
-            video_player.ondurationchange = undefined;
-            // Duration has caught up, let's continue
-            // FIXME: Getting a lot of this error when seeking around quickly:
-            //        > Uncaught (in promise) DOMException: The play() request was interrupted by a call to pause(). https://goo.gl/LdLk22
-            if (unpause && video_player.paused) {
-                video_player.play()
-            };
-        }
-    }
-}
 function videoSeek(time) {
-    // The browser might not yet have cached what's being seeked to,
-    // or the server might not even have transcoded that part yet.
-    // So if seeking beyond what the browser thinks is the current end time,
-    // just wait for the cache to catch up but keep jumping forward to keep the browser focused.
-    //
-    // FIXME: Figure out seeking beyond the currently buffered duration.
-    //        Perhaps this requires pausing until duration >= seeked_time
+    // The server's manifest always covers the whole file, and it transcodes whatever gets seeked to on demand,
+    // so there's no need to wait for anything to catch up before jumping there.
     if (time >= video_player.total_duration) {
         console.log("Seeking beyond end of file, I don't know how to deal with this yet");
     } else {
-        if (video_player.paused != true) {
-            was_paused = false;
-            video_player.pause();
-        } else {
-            was_paused = true;
-        }
-        _videoSeekBeyondDuration(time, !was_paused)
+        video_player.currentTime = Math.max(time, 0);
     }
 }
 
@@ -375,6 +337,70 @@ function add_subtitles() {
     return
 }
 
+function parseVttTime(timestamp) {
+    // Either HH:MM:SS.mmm or MM:SS.mmm
+    return timestamp.split(':').reduce((seconds, part) => seconds * 60 + parseFloat(part), 0);
+}
+
+function add_trickplay() {
+    var seekBar = document.getElementById("seek-bar");
+    var preview = document.getElementById("seek-preview");
+    var req = new XMLHttpRequest();
+    req.open("GET", document.URL+"/thumbnails.vtt", true);
+    req.onload = function(e) {
+        if (req.status == 503) {
+            // The server's still generating them, try again when it says to
+            var retry_after = parseInt(req.getResponseHeader("Retry-After")) || 30;
+            setTimeout(add_trickplay, retry_after * 1000);
+            return;
+        } else if (req.status != 200) {
+            return;  // No previews for this one
+        }
+
+        // Each cue is the time range followed by the sprite sheet & where in it the preview is
+        var cues = [];
+        for (var block of req.responseText.split(/\n\s*\n/)) {
+            var lines = block.trim().split("\n");
+            var i = lines.findIndex(line => line.includes("-->"));
+            if (i < 0 || i + 1 >= lines.length) {
+                continue;  // The WEBVTT header
+            }
+            var times = lines[i].split("-->");
+            var [src, xywh] = lines[i+1].split("#xywh=");
+            var [x, y, w, h] = xywh.split(",").map(Number);
+            cues.push({start: parseVttTime(times[0].trim()), end: parseVttTime(times[1].trim()),
+                       src: document.URL+"/"+src, x: x, y: y, w: w, h: h});
+        }
+        if (cues.length == 0) {
+            return;
+        }
+
+        var show_preview = function(time) {
+            var cue = cues.find(cue => time >= cue.start && time < cue.end) || cues[cues.length-1];
+            preview.style.width = cue.w+"px";
+            preview.style.height = cue.h+"px";
+            preview.style.backgroundImage = "url('"+cue.src+"')";
+            preview.style.backgroundPosition = (-cue.x)+"px "+(-cue.y)+"px";
+            preview.innerText = secondsToString(Math.floor(time));
+            // Keep it centred over the mouse, but not hanging off either end of the seek bar
+            var centre = time / video_player.total_duration * seekBar.clientWidth;
+            preview.style.left = Math.min(Math.max(centre - cue.w/2, 0), seekBar.clientWidth - cue.w)+"px";
+            preview.classList.add("visible");
+        }
+
+        seekBar.addEventListener("mousemove", function(ev) {
+            if (video_player.total_duration) {
+                show_preview(ev.offsetX / seekBar.clientWidth * video_player.total_duration);
+            }
+        });
+        // While the handle's being dragged show where it's going to, rather than wherever the mouse is
+        seekBar.addEventListener("input", ev => show_preview(ev.target.valueAsNumber));
+        seekBar.addEventListener("mouseleave", _ => preview.classList.remove("visible"));
+        seekBar.addEventListener("change",     _ => preview.classList.remove("visible"));
+    }
+    req.send()
+}
+
 function init_hls() {
     /* Chrome/etc doesn't actually support HLS out of the box, so lets fix that.
      * This is just the Getting Started example from the hls.js documentation
@@ -501,6 +527,8 @@ window.onload = function() {
     init_hls();
 
     add_subtitles();
+
+    add_trickplay();
     
     // NotYetImplemented
     setup_casting();
@@ -0,0 +1,660 @@
+#!/usr/bin/python3
+import heapq
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import flask
+
+import cache
+import ffmpeg
+import inotify
+import metrics
+
+# FIXME: Put these in a config file somehow
+_CONFIG_MAX_TRANSCODES = 2  # How many ffmpeg processes may be encoding at once
+_CONFIG_QUEUE_TIMEOUT = 10  # How long (seconds) to wait for one of those to free up before giving up
+_CONFIG_IDLE_TIMEOUT = 60  # How long (seconds) since the last request before deciding the viewer has gone away
+_CONFIG_SEGMENT_TIMEOUT = 30  # How long (seconds) to wait for ffmpeg to produce a requested segment
+# If a segment this far ahead of the encoder gets requested, assume the viewer has seeked and restart ffmpeg from there
+_CONFIG_SEEK_RESTART_SEGMENTS = 5
+_CONFIG_TRANSCODE_CACHE_SIZE = 20 * 1024 * 1024 * 1024  # 20GB
+# Send clients asking for hls-manifest.m3u8 to the adaptive bitrate master manifest instead.
+# NOTE: This always transcodes the video (several times over) so is much harder on the CPU than the default profile
+_CONFIG_ADAPTIVE_BITRATE = False
+# Send clients asking for hls-manifest.m3u8 to the fMP4 single file manifest instead.
+# NOTE: That can't jump ahead of the transcode when seeking, so is best for files that have already been transcoded
+_CONFIG_SINGLE_FILE = False
+_CONFIG_STREAM_CHUNK_SIZE = 64 * 1024  # How much of ffmpeg's output to pass on at a time when streaming
+# Background pre-transcoding (see schedule()) only uses transcode slots nobody's watching anything with,
+# and gets kicked off them as soon as a viewer needs one.
+_CONFIG_WARM_SEGMENTS = 10  # How many segments from the start of a file to pre-transcode
+_CONFIG_BACKGROUND_THREADS = 1  # How many CPU cores each background ffmpeg may use
+
+# Lower numbers go first
+PRIORITY_NEXT_EPISODE = 0
+PRIORITY_NEW_ARRIVAL = 10
+
+
+class TooManyTranscodes(Exception):
+    pass
+
+
+class Session():
+    """A single transcode, shared by every client watching the same thing.
+
+    ffmpeg gets restarted from wherever a client seeks to, but only ever one ffmpeg per session.
+    """
+
+    def __init__(self, key, output_dir: str, fileuri: str, profile: str):
+        self.key = key
+        self.output_dir = output_dir
+        self.fileuri = fileuri
+        self.profile = profile
+        self.duration = ffmpeg.get_duration(fileuri)
+        if profile == 'abr':
+            self.renditions = ffmpeg.get_renditions(ffmpeg.probe(fileuri))
+            self.variants = list(range(len(self.renditions)))
+        else:
+            self.renditions = None
+            self.variants = [None]
+        self._state_path = os.path.join(output_dir, 'state.json')
+        try:
+            with open(self._state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = None
+        if state is None:
+            self.complete = False
+            self.segment_times = ffmpeg.get_segment_times(fileuri, profile)
+            self._write_state()
+        else:
+            self.complete = state['complete']
+            # Any segments already transcoded were cut at these times, so stick with them even if the keyframes are known now.
+            # Older state files don't have them, those were all cut every SEGMENT_LENGTH (or near enough).
+            self.segment_times = state.get('segment_times') or \
+                ffmpeg.get_segment_times(fileuri, profile, use_keyframes=False)
+        self.segment_count = len(self.segment_times) - 1
+        self.process = None
+        self.start_segment = 0
+        # The segment ffmpeg is expected to produce next
+        self._next_segment = 0
+        self.last_access = time.monotonic()
+        # Held while (re)starting ffmpeg, so that anyone else wanting this session waits for that instead of starting another
+        self._start_lock = threading.Lock()
+        # Set once the current ffmpeg has been told to stop, see _follow_segments()
+        self._stopping = threading.Event()
+        self._has_slot = False
+        # Whether the current ffmpeg is background pre-transcoding rather than for an actual viewer
+        self.background = False
+        # Notified whenever a segment might have become ready, or ffmpeg might have died
+        self._ready = threading.Condition()
+        # The latest report from ffmpeg's -progress output
+        self.progress = {}
+
+    def __repr__(self):
+        return '<{modname}.{classname} {key!r}>'.format(
+            modname=self.__module__, classname=self.__class__.__name__, key=self.key)
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def _write_state(self):
+        # Written atomically so a crash can't leave a half-written one behind
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump({
+                'fileuri': self.fileuri,
+                'profile': self.profile,
+                'segment_count': len(self.segment_times) - 1,
+                'segment_times': self.segment_times,
+                'complete': self.complete,
+            }, f)
+        os.replace(self._state_path + '.tmp', self._state_path)
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def get_master_manifest(self):
+        """Generate the master manifest listing each of the adaptive bitrate renditions"""
+        assert self.renditions, "Only the 'abr' profile has more than one rendition"
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for variant, rendition in enumerate(self.renditions):
+            lines.append('#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},'
+                         'CODECS="{codecs}"'.format(**rendition))
+            lines.append('hls-v{variant:d}.m3u8'.format(variant=variant))
+        return '\n'.join(lines) + '\n'
+
+    def get_manifest(self, variant=None):
+        """Generate the full VOD manifest, regardless of how much has actually been transcoded yet"""
+        lengths = [end - start for start, end in zip(self.segment_times, self.segment_times[1:])]
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            # Every segment's length has to round to no more than this
+            '#EXT-X-TARGETDURATION:{:d}'.format(max(ffmpeg.SEGMENT_LENGTH, round(max(lengths, default=0)))),
+            '#EXT-X-PLAYLIST-TYPE:VOD',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+        ]
+        for index, length in enumerate(lengths):
+            lines.append('#EXTINF:{:f},'.format(length))
+            lines.append(ffmpeg.segment_filename(index, variant))
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def get_single_file_manifest(self):
+        """Get ffmpeg's manifest for the single_file profile, or None if there's no segments in it yet"""
+        try:
+            with open(os.path.join(self.output_dir, ffmpeg.SINGLE_FILE_MANIFEST)) as f:
+                manifest = f.read()
+        except FileNotFoundError:
+            return None
+        if '#EXT-X-ENDLIST' in manifest:
+            return manifest
+        # ffmpeg rewrites it in place, so there might be half a segment's entry on the end. Cut that off.
+        end = manifest.rfind(ffmpeg.SINGLE_FILE + '\n')
+        if end == -1:
+            return None
+        return manifest[:end + len(ffmpeg.SINGLE_FILE) + 1]
+
+    def has_segment(self, index: int, variant=None):
+        # The segments only get renamed into place once they're complete
+        return self.complete or os.path.isfile(os.path.join(self.output_dir, ffmpeg.segment_filename(index, variant)))
+
+    def _has_all_variants(self, index: int):
+        return all(self.has_segment(index, variant) for variant in self.variants)
+
+    def _encoder_position(self):
+        while self._next_segment < self.segment_count and self._has_all_variants(self._next_segment):
+            self._next_segment += 1
+        return self._next_segment
+
+    def ensure_encoding(self, index: int, background=False, segment_limit=None):
+        """Make sure ffmpeg will be producing segment index soon, (re)starting it if need be.
+
+        Background transcodes only happen if there's a spare transcode slot, and only do segment_limit segments.
+        """
+        with self._start_lock:
+            if self.running and self.start_segment <= index <= self._encoder_position() + _CONFIG_SEEK_RESTART_SEGMENTS:
+                if background or not self.background:
+                    # It'll get there soon enough on its own
+                    return
+                # Otherwise a viewer is waiting on what's currently a low priority ffmpeg, so restart it at full speed
+
+            if not self._has_slot:
+                if background:
+                    if not _slots.acquire(blocking=False):
+                        raise TooManyTranscodes("No spare transcode slots for background work")
+                else:
+                    # Viewers always come first, so this will kick any background work off its slot
+                    _acquire_slot()
+                self._has_slot = True
+
+            # NOTE: Any segments already transcoded are kept, so seeking back to them later costs nothing.
+            # FIXME: A restarted ffmpeg will redo any segments past this point that already exist.
+            self._stop_process()
+            try:
+                self.process = ffmpeg.start_transcode(
+                    self.output_dir, self.fileuri, start_segment=index, profile=self.profile,
+                    background_threads=_CONFIG_BACKGROUND_THREADS if background else None,
+                    segment_limit=segment_limit, segment_times=self.segment_times)
+            except BaseException:
+                self._release_slot()
+                raise
+            self.background = background
+            self.start_segment = self._next_segment = index
+            self._stopping = threading.Event()
+            _segment_watcher.watch(self)
+            segment_follower = None
+            if self.process.segment_list is not None:
+                segment_follower = threading.Thread(target=self._follow_segments, args=(self.process, self._stopping),
+                                                    name='ffmpeg-segments {}'.format(index), daemon=True)
+                segment_follower.start()
+            threading.Thread(target=self._follow_progress, args=(self.process, segment_follower),
+                             name='ffmpeg-progress {}'.format(index), daemon=True).start()
+
+    def _follow_segments(self, process, stopping):
+        for filename in ffmpeg.read_segment_list(process):
+            if stopping.is_set():
+                # Could well be the one ffmpeg was part way through when it was stopped, so it can't be trusted
+                continue
+            tmp_path = os.path.join(self.output_dir, filename)
+            if tmp_path.endswith('.tmp'):
+                os.replace(tmp_path, tmp_path[:-len('.tmp')])
+            self.notify()
+
+    def _follow_progress(self, process, segment_follower=None):
+        for progress in ffmpeg.read_progress(process):
+            if process is self.process:
+                self.progress = progress
+            self.notify()
+        # ffmpeg has exited, anyone still waiting on a segment needs to know it's not coming
+        process.wait()
+        if segment_follower is not None:
+            # Make sure the last segment's been put in place before checking whether that was all of them
+            segment_follower.join()
+        if process.returncode == 0 and (self.profile == 'single_file' or
+                                        all(self._has_all_variants(i) for i in range(self.segment_count))):
+            # Everything's been transcoded, so nothing will ever need to run ffmpeg for this again
+            self.complete = True
+            self._write_state()
+        _transcode_cache.refresh(self.key)
+        self.notify()
+
+    def notify(self):
+        with self._ready:
+            self._ready.notify_all()
+
+    def wait_for(self, ready, timeout=_CONFIG_SEGMENT_TIMEOUT):
+        """Wait for ready() to return something true, returns that or something false if it didn't happen in time"""
+        # Woken up by inotify as soon as ffmpeg renames a segment into place or rewrites its manifest,
+        # or failing that by ffmpeg's next progress report.
+        with self._ready:
+            self._ready.wait_for(lambda: ready() or not self.running, timeout=timeout)
+        # Check once more in case ffmpeg finished it right as it exited
+        return ready()
+
+    def wait_for_segment(self, index: int, variant=None, timeout=_CONFIG_SEGMENT_TIMEOUT):
+        """Wait for segment index to be ready, returns False if it didn't happen in time"""
+        return self.wait_for(lambda: self.has_segment(index, variant), timeout=timeout)
+
+    def _stop_process(self):
+        if self.running:
+            self._stopping.set()
+            # ffmpeg doesn't acknowledge a SIGTERM, but it does die on SIGINT
+            self.process.send_signal(signal.SIGINT)
+            # If that didn't work, SIGKILL it
+            try: self.process.wait(timeout=2)                      # noqa: E701
+            except subprocess.TimeoutExpired: self.process.kill()  # noqa: E701
+
+    def stop(self):
+        with self._start_lock:
+            self._stop_process()
+            self._release_slot()
+        _segment_watcher.unwatch(self)
+
+    def stop_if_idle(self):
+        """Stop the transcode if ffmpeg has exited or nobody's asked for anything in a while, returns whether it did"""
+        with self._start_lock:
+            # Checked with the lock held, since ensure_encoding() might be part way through restarting ffmpeg for a seek,
+            # in which case the old ffmpeg looks finished but the new one is very much wanted.
+            idle = time.monotonic() - self.last_access >= _CONFIG_IDLE_TIMEOUT
+            if not idle and (self.running or self.process is None):
+                return False
+
+            if self.running:
+                print("Viewer of", self, "went away, stopping transcode", file=sys.stderr)
+            elif self.process is not None and self.process.returncode != 0:
+                print(self, "ffmpeg exited with", self.process.returncode, file=sys.stderr)
+            self._stop_process()
+            self._release_slot()
+        _segment_watcher.unwatch(self)
+        return True
+
+    def _release_slot(self):
+        if self._has_slot:
+            self._has_slot = False
+            _slots.release()
+
+
+class _SegmentWatcher():
+    """Wakes up sessions as soon as ffmpeg finishes writing a segment"""
+    # ffmpeg writes each segment to a .tmp file and then renames it, so IN_MOVED_TO is the important one
+    _WATCH_MASK = inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE | inotify.IN_ONLYDIR
+
+    def __init__(self):
+        self._inotify = None
+        self._lock = threading.Lock()
+        self._sessions = {}  # wd -> Session
+
+    def watch(self, session):
+        with self._lock:
+            if self._inotify is None:
+                try:
+                    self._inotify = inotify.Inotify()
+                except OSError as e:
+                    print("WARNING: Can't use inotify, relying on ffmpeg's progress reports instead:", e, file=sys.stderr)
+                    self._inotify = False
+                else:
+                    threading.Thread(target=self._watch_loop, name='segment-watcher', daemon=True).start()
+            if not self._inotify or session in self._sessions.values():
+                return
+            try:
+                wd = self._inotify.add_watch(session.output_dir, self._WATCH_MASK)
+            except OSError as e:
+                print("WARNING: Can't watch", session.output_dir, e, file=sys.stderr)
+            else:
+                self._sessions[wd] = session
+
+    def unwatch(self, session):
+        with self._lock:
+            for wd, watched in list(self._sessions.items()):
+                if watched is session:
+                    del self._sessions[wd]
+                    self._inotify.rm_watch(wd)
+
+    def _watch_loop(self):
+        while True:
+            for event in self._inotify.read():
+                session = self._sessions.get(event.wd)
+                if session is not None and event.name.endswith(('.ts', '.m3u8')):
+                    session.notify()
+
+
+class _TranscodeCache(cache.DiskCache):
+    def _clean_entry(self, path):
+        super()._clean_entry(path)
+        # Without a state file it's not even known what the entry is for,
+        # presumably we crashed while setting it up, so there's nothing worth keeping.
+        return os.path.isfile(os.path.join(path, 'state.json'))
+
+
+_transcode_cache = _TranscodeCache('transcodes', max_bytes=_CONFIG_TRANSCODE_CACHE_SIZE)
+_segment_watcher = _SegmentWatcher()
+_slots = threading.BoundedSemaphore(_CONFIG_MAX_TRANSCODES)
+_sessions = {}
+_sessions_lock = threading.Lock()
+_reaper = None
+
+
+def _reap():
+    while True:
+        time.sleep(5)
+        with _sessions_lock:
+            sessions = list(_sessions.values())
+        for session in sessions:
+            if session.running and time.monotonic() - session.last_access < _CONFIG_IDLE_TIMEOUT:
+                # Keep the cache up to date on how much space this is taking up
+                _transcode_cache.refresh(session.key)
+                continue
+            elif session.process is None and time.monotonic() - session.last_access < _CONFIG_IDLE_TIMEOUT:
+                # Nothing's asked for a segment yet
+                continue
+
+            if not session.stop_if_idle():
+                # Someone came back to it while we weren't looking
+                continue
+            with _sessions_lock:
+                if _sessions.get(session.key) is session:
+                    del _sessions[session.key]
+                    _transcode_cache.unpin(session.key)
+            _transcode_cache.refresh(session.key)
+
+
+def _preempt_background():
+    with _sessions_lock:
+        background = [session for session in _sessions.values() if session.background and session.running]
+    if background:
+        print("Stopping background transcode of", background[0], "to make room for a viewer", file=sys.stderr)
+        # The scheduler will notice and try again later
+        background[0].stop()
+
+
+class _Scheduler():
+    """Priority queue of files to pre-transcode the start of in the background"""
+
+    def __init__(self):
+        self._queue = []
+        self._queued = set()
+        self._counter = itertools.count()  # Keeps the queue first-in-first-out within a priority
+        self._condition = threading.Condition()
+        self._worker = None
+
+    def schedule(self, fileuri: str, priority: int):
+        with self._condition:
+            if fileuri in self._queued:
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='transcode-scheduler', daemon=True)
+                self._worker.start()
+            self._queued.add(fileuri)
+            heapq.heappush(self._queue, (priority, next(self._counter), fileuri))
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._queue)
+                    priority, _, fileuri = heapq.heappop(self._queue)
+                    self._queued.discard(fileuri)
+                try:
+                    if not self._warm(fileuri):
+                        # Didn't get to finish, so put it back in the queue and give the viewers some breathing room
+                        self.schedule(fileuri, priority)
+                        time.sleep(30)
+                except Exception as e:
+                    # Such as a file that's still being copied in and has no duration yet.
+                    # Whatever it is, it's only this one file that's broken, so carry on with the rest.
+                    print("WARNING: Couldn't pre-transcode", fileuri, repr(e), file=sys.stderr)
+        finally:
+            # Just in case, so the next schedule() starts another rather than queueing up for nobody
+            with self._condition:
+                self._worker = None
+
+    def _warm(self, fileuri: str):
+        """Pre-transcode the first few segments of fileuri, returns False if that needs trying again later"""
+        # Nobody's waiting on this, so there's time to find the keyframes first and get the segments right from the start
+        ffmpeg.get_keyframes(fileuri)
+        # Likewise the seek bar previews, so they're there the first time it's watched
+        try:
+            ffmpeg.get_trickplay(fileuri)
+        except (FileNotFoundError, subprocess.CalledProcessError) as e:
+            # No video to preview, or ffmpeg choked on it, neither of which is worth not transcoding it over
+            print("WARNING: Couldn't generate seek previews of", fileuri, e, file=sys.stderr)
+        session = get_session(fileuri)
+        segments = min(_CONFIG_WARM_SEGMENTS, session.segment_count)
+        if session.running or all(session.has_segment(i) for i in range(segments)):
+            # Someone's already watching it, or it's already been done
+            return True
+
+        try:
+            session.ensure_encoding(0, background=True, segment_limit=segments)
+        except TooManyTranscodes:
+            return False
+        process = session.process
+        while process.poll() is None:
+            # Don't let the reaper think nobody wants this
+            session.touch()
+            time.sleep(1)
+        if session.process is process and session.background:
+            session.stop()
+        # If a viewer started watching it in the meantime that's just as good as finishing
+        return process.returncode == 0 or session.process is not process
+
+
+_scheduler = _Scheduler()
+
+
+def schedule(fileuri: str, priority=PRIORITY_NEW_ARRIVAL):
+    """Pre-transcode the start of fileuri in the background, so it starts instantly when someone hits play"""
+    _scheduler.schedule(fileuri, priority)
+
+
+def _acquire_slot():
+    if not _slots.acquire(blocking=False):
+        _preempt_background()
+        if not _slots.acquire(timeout=_CONFIG_QUEUE_TIMEOUT):
+            raise TooManyTranscodes("Already running {} transcodes".format(_CONFIG_MAX_TRANSCODES))
+
+
+# Streams don't have a Session, so their ffmpegs get kept track of separately for the metrics
+_stream_processes = set()
+
+
+def _count_ffmpegs():
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    return {
+        ('hls', 'foreground'): sum(1 for s in sessions if s.running and not s.background),
+        ('hls', 'background'): sum(1 for s in sessions if s.running and s.background),
+        ('stream', 'foreground'): len(_stream_processes),
+    }
+
+
+_ffmpeg_processes = metrics.Gauge('webemcee_ffmpeg_processes', "Running ffmpeg transcodes",
+                                  ('kind', 'priority'), function=_count_ffmpegs)
+_segment_wait = metrics.Histogram('webemcee_segment_wait_seconds',
+                                  "How long segment requests waited on ffmpeg, for segments that weren't ready yet",
+                                  ('profile',))
+
+
+def _stream_chunks(process):
+    # read1() hands over whatever ffmpeg has produced so far rather than waiting for a full chunk.
+    # Since this only reads as fast as the client takes it, a slow client leaves ffmpeg blocked on a full pipe,
+    # so there's never more than the pipe's & this chunk's worth sitting in memory.
+    while True:
+        chunk = process.stdout.read1(_CONFIG_STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _stop_stream(process):
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+    process.stdout.close()
+    _slots.release()
+    _stream_processes.discard(process)
+
+
+def stream(fileuri: str, start_time=0):
+    """Stream fileuri as one fragmented mp4 straight out of ffmpeg, without writing anything to disk"""
+    _acquire_slot()
+    try:
+        process = ffmpeg.start_stream(fileuri, start_time)
+    except BaseException:
+        _slots.release()
+        raise
+    _stream_processes.add(process)
+    # NOTE: No Content-Length or Range support, since nobody knows how big it'll be until it's done
+    resp = flask.Response(_stream_chunks(process), mimetype='video/mp4')
+    # The WSGI server closes the response when the client goes away, so ffmpeg gets stopped right away.
+    # NOTE: This can't go in a finally in _stream_chunks(), since that never runs if the generator's closed before
+    #       it's started, which is exactly what happens for a HEAD request.
+    #       Nor can the response be direct_passthrough, since then werkzeug never calls this.
+    resp.call_on_close(lambda: _stop_stream(process))
+    return resp
+
+
+def _cache_key(fileuri: str, profile: str):
+    # FIXME: Only works for local files
+    # Keyed on the file itself rather than its path, so watching it through a symlink reuses the same transcode
+    return _transcode_cache.key(*cache.media_key(urllib.parse.urlparse(fileuri).path), profile)
+
+
+def get_session(fileuri: str, profile='default'):
+    """Get the transcode session for fileuri, creating one if nobody else already has"""
+    global _reaper
+    key = _cache_key(fileuri, profile)
+    # Make sure the probe is cached before grabbing the lock, so nobody's kept waiting on ffprobe for some other file
+    ffmpeg.probe(fileuri)
+    if ffmpeg.keyframes_pending(fileuri, profile):
+        # Copied video can only be cut on its keyframes, so any plan made without them would be wrong from the start.
+        # Likewise done before grabbing the lock, since that means reading the whole file.
+        try:
+            ffmpeg.get_keyframes(fileuri)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("WARNING: Couldn't scan keyframes of", fileuri, "segments won't match the manifest:", e, file=sys.stderr)
+    with _sessions_lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap, name='transcode-reaper', daemon=True)
+            _reaper.start()
+        session = _sessions.get(key)
+        if session is None:
+            # Anything left in the cache from before is reused, and it can't be evicted while it's in use
+            output_dir = _transcode_cache.makedir(key)
+            _transcode_cache.pin(key)
+            try:
+                session = _sessions[key] = Session(key, output_dir, fileuri, profile)
+            except BaseException:
+                _transcode_cache.unpin(key)
+                raise
+    session.touch()
+    return session
+
+
+def _has_renditions(fileuri: str):
+    # Without any video there's nothing to scale, so the 'abr' profile can't do anything with it
+    return bool(ffmpeg.get_renditions(ffmpeg.probe(fileuri)))
+
+
+def get_manifest(fileuri: str):
+    if _CONFIG_ADAPTIVE_BITRATE and _has_renditions(fileuri):
+        # hls.js resolves the variant manifests relative to where it got redirected to, so this is all it takes
+        return flask.redirect('hls-master.m3u8')
+    elif _CONFIG_SINGLE_FILE:
+        return flask.redirect('hls-single.m3u8')
+    return get_variant_manifest(fileuri, variant=None)
+
+
+def get_master_manifest(fileuri: str):
+    if not _has_renditions(fileuri):
+        # get_manifest() won't send it back here, so this is safe
+        return flask.redirect('hls-manifest.m3u8')
+    session = get_session(fileuri, profile='abr')
+    if not session.has_segment(0, variant=0):
+        session.ensure_encoding(0)
+
+    resp = flask.make_response(session.get_master_manifest())
+    resp.mimetype = 'application/x-mpegURL'
+    return resp
+
+
+def get_variant_manifest(fileuri: str, variant=None):
+    session = get_session(fileuri, profile='default' if variant is None else 'abr')
+    if variant is not None and variant not in session.variants:
+        return "No such variant", 404
+    # Get a head start on the first segment, since that's almost certainly going to be asked for next
+    if not session.has_segment(0, variant):
+        session.ensure_encoding(0)
+
+    resp = flask.make_response(session.get_manifest(variant))
+    resp.mimetype = 'application/x-mpegURL'
+    return resp
+
+
+def get_single_file_manifest(fileuri: str):
+    session = get_session(fileuri, profile='single_file')
+    if not session.complete:
+        session.ensure_encoding(0)
+    # ffmpeg doesn't write its manifest until it's finished the first segment
+    manifest = session.wait_for(session.get_single_file_manifest)
+    if not manifest:
+        return "Manifest not ready", 404
+
+    resp = flask.make_response(manifest)
+    resp.mimetype = 'application/x-mpegURL'
+    return resp
+
+
+def get_single_file(fileuri: str):
+    """Get the path of the single_file profile's fMP4 file, for the caller to serve byte ranges out of"""
+    session = get_session(fileuri, profile='single_file')
+    # NOTE: Only the parts the manifest already lists will be asked for, so there's no waiting around for ffmpeg here.
+    return os.path.join(session.output_dir, ffmpeg.SINGLE_FILE)
+
+
+def get_segment(fileuri: str, index: int, variant=None):
+    session = get_session(fileuri, profile='default' if variant is None else 'abr')
+    if not 0 <= index < session.segment_count or variant not in session.variants:
+        return "No such segment", 404
+
+    if session.has_segment(index, variant):
+        metrics.cache_lookups.inc(cache='segment', result='hit')
+    else:
+        metrics.cache_lookups.inc(cache='segment', result='miss')
+        with _segment_wait.time(profile=session.profile):
+            session.ensure_encoding(index)
+            ready = session.wait_for_segment(index, variant)
+        if not ready:
+            return "Segment not ready", 404
+
+    return flask.send_from_directory(session.output_dir, ffmpeg.segment_filename(index, variant), mimetype='video/mp2t')
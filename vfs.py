@@ -1,9 +1,17 @@
 #!/usr/bin/python3
-import base64
+import bisect
+import collections
+import concurrent.futures
 import errno
 import io
+import itertools
+import json
 import os
+import sqlite3
+import stat
 import sys
+import threading
+import time
 import urllib.parse
 
 import configparser  # FIXME: Only used for backcompat with UPMC
@@ -11,37 +19,103 @@ import configparser  # FIXME: Only used for backcompat with UPMC
 import PIL.Image
 import magic
 
+import cache
+import covers
+import inotify
+import metrics
+import search
+
 # FIXME: Put this in a config file somehow
 _CONFIG_MEDIA_PATH = '/srv/media/Video'
-
-## FIXME: This magic library is not threadsafe, find an alternative.
-# FIXME: Use a smaller (presumably therefore more efficient) database file.
-#        Perhaps with just video/* & image/* filetypes in it?
-magic_db = magic.open(sum((
-    magic.SYMLINK,  # Follow symlinks
-    magic.MIME_TYPE,  # Just report the mimetype, don't make it human-readable.
-    magic.PRESERVE_ATIME,  # Preserve the file access time, since I'm only using this when listing the directories
-    # Literally just [i for i in dir(magic) if i.startswith('NO_CHECK')]
-    # I expect that by disabling all these checks it should be quicker & more efficient.
-    magic.NO_CHECK_APPTYPE,
-    magic.NO_CHECK_BUILTIN,
-    magic.NO_CHECK_CDF,
-    magic.NO_CHECK_COMPRESS,
-    magic.NO_CHECK_ELF,
-    magic.NO_CHECK_ENCODING,
-    magic.NO_CHECK_SOFT,
-    magic.NO_CHECK_TAR,
-    # I need to actually check for text files for the .info files
-    # magic.NO_CHECK_TEXT
-    magic.NO_CHECK_TOKENS,
-)))
-magic_db.load()  # FIXME: Does this close cleanly?
+_CONFIG_THUMBNAIL_CACHE_SIZE = 256 * 1024 * 1024  # 256MB
+_CONFIG_METADATA_IMPORT_THREADS = 8
+_CONFIG_METADATA_WRITE_DELAY = 1  # How long (seconds) to gather up .info files parsed on demand before storing them
+_CONFIG_LISTING_THREADS = 8  # How many directory entries to build at once when listing a folder
+_CONFIG_SEARCH_MAX_FIELD_LENGTH = 200  # Longer .info fields (such as plot summaries) aren't searched, they'd match everything
+
+THUMBNAIL_SIZE = (280, 180)  # FIXME: Default size inherited from UPMC, get a better size
+
+_thumbnail_cache = cache.DiskCache('thumbnails', max_bytes=_CONFIG_THUMBNAIL_CACHE_SIZE)
+
+# Anything with these extensions is assumed to be what it says it is, without asking libmagic.
+# This covers the vast majority of a media library, including all the UPMC sidecar files and folder.jpg covers.
+_EXTENSION_MIMETYPES = {
+    # Videos
+    'avi': 'video/x-msvideo',
+    'm4v': 'video/x-m4v',
+    'mkv': 'video/x-matroska',
+    'mov': 'video/quicktime',
+    'mp4': 'video/mp4',
+    'mpeg': 'video/mpeg',
+    'mpg': 'video/mpeg',
+    'ogv': 'video/ogg',
+    'webm': 'video/webm',
+    'wmv': 'video/x-ms-wmv',
+    # NOTE: Deliberately not including 'ts' since that's just as likely to be TypeScript as MPEG-TS.
+    # Images
+    'gif': 'image/gif',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    # Sidecars
+    'info': 'text/plain',  # UPMC's metadata files
+    'srt': 'application/x-subrip',
+    'vtt': 'text/vtt',
+}
+
+
+def _open_magic_db():
+    # FIXME: Use a smaller (presumably therefore more efficient) database file.
+    #        Perhaps with just video/* & image/* filetypes in it?
+    magic_db = magic.open(sum((
+        magic.SYMLINK,  # Follow symlinks
+        magic.MIME_TYPE,  # Just report the mimetype, don't make it human-readable.
+        magic.PRESERVE_ATIME,  # Preserve the file access time, since I'm only using this when listing the directories
+        # Literally just [i for i in dir(magic) if i.startswith('NO_CHECK')]
+        # I expect that by disabling all these checks it should be quicker & more efficient.
+        magic.NO_CHECK_APPTYPE,
+        magic.NO_CHECK_BUILTIN,
+        magic.NO_CHECK_CDF,
+        magic.NO_CHECK_COMPRESS,
+        magic.NO_CHECK_ELF,
+        magic.NO_CHECK_ENCODING,
+        magic.NO_CHECK_SOFT,
+        magic.NO_CHECK_TAR,
+        # I need to actually check for text files for the .info files
+        # magic.NO_CHECK_TEXT
+        magic.NO_CHECK_TOKENS,
+    )))
+    magic_db.load()  # FIXME: Does this close cleanly?
+    return magic_db
+
+
+# The magic library is not threadsafe, but Flask is running threaded, so each thread gets its own handle.
+_magic_dbs = threading.local()
+# Maps cache.media_key() -> mimetype, so a file only ever needs to be read by libmagic once.
+_magic_results = {}
+
+
+def _get_mimetype(path):
+    ext = os.path.basename(path).rpartition(os.path.extsep)[2].lower()
+    if ext in _EXTENSION_MIMETYPES:
+        return _EXTENSION_MIMETYPES[ext]
+
+    # Ambiguous, so fall back to actually reading the file
+    key = cache.media_key(path)
+    metrics.cache_lookups.inc(cache='magic', result='hit' if key in _magic_results else 'miss')
+    if key not in _magic_results:
+        if not hasattr(_magic_dbs, 'db'):
+            _magic_dbs.db = _open_magic_db()
+        _magic_results[key] = _magic_dbs.db.file(path)
+    return _magic_results[key]
 
 
 class vfs_Object():
     """Base class for other vfs objects to inherit"""
     # I want to cache all of these values, but only after they've been queried at least once
     _uri = None
+    _media_id = None
     _sortkey = None
     _mimetype = ''
     _islocal = True
@@ -56,18 +130,19 @@ class vfs_Object():
         if self.__class__.__name__ == 'vfs_Object':
             raise NotImplementedError("vfs_Object is not supposed to be used directly")
 
-        self._fullpath = _get_last_rel_link_in_media_dir(
-            os.path.join(os.path.abspath(_CONFIG_MEDIA_PATH), path))
-        self._relpath = os.path.relpath(self._fullpath, start=_CONFIG_MEDIA_PATH)
-
         if self._islocal:
-            if not os.path.exists(self._fullpath):
+            try:
+                self._fullpath, self._media_id, is_dir = resolve(os.path.join(os.path.abspath(_CONFIG_MEDIA_PATH), path))
+            except FileNotFoundError:
                 raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
             if self._isfile is not None:
-                if self._isfile and not os.path.isfile(self._fullpath):
+                if self._isfile and is_dir:
                     raise FileNotFoundError(errno.ENOENT, "Not a file", path)
-                elif not self._isfile and not os.path.isdir(self._fullpath):
+                elif not self._isfile and not is_dir:
                     raise FileNotFoundError(errno.ENOENT, "Not a directory", path)
+        else:
+            self._fullpath = os.path.join(os.path.abspath(_CONFIG_MEDIA_PATH), path)
+        self._relpath = os.path.relpath(self._fullpath, start=_CONFIG_MEDIA_PATH)
 
         # Need to strip os.path.sep first to stop 'foo/bar/' from returning '', because it ends with a '/'
         # NOTE: Name must be set from the original path (or metadata) not the path after following symlinks around
@@ -91,6 +166,11 @@ class vfs_Object():
     def path(self):
         return self._relpath
 
+    @property
+    def media_id(self):
+        """The (st_dev, st_ino) of what this really is, the same for every symlink to it, or None if it's not local"""
+        return self._media_id
+
     @property
     def name(self):
         return self._name
@@ -102,7 +182,7 @@ class vfs_Object():
     @property
     def mimetype(self):
         if not self._mimetype:
-            self._mimetype = magic_db.file(self._fullpath)
+            self._mimetype = _get_mimetype(self._fullpath)
         return self._mimetype
 
     @property
@@ -121,27 +201,137 @@ class File(vfs_Object):
 
 class _Metadata(File):
     # This class is only for backcompat with UPMC's stupid .info files. that's why it's read-only.
-    # At the very least I should be using json, if not a sqlite database/etc
+    # The parsed contents come from _metadata_store, so each file only gets parsed once rather than every listing.
     def __init__(self, path, mimetype='text/plain', **kwargs):
         super().__init__(path, mimetype, **kwargs)
-        self.meta = configparser.ConfigParser()
-        self.meta.read(path)
+        self.meta = get_metadata(self._fullpath)
 
     def __getitem__(self, item):
-        if self.meta.has_section('local') and self.meta.has_option('local', item):
-            return self.meta.get('local', item).rstrip(' | ')
-        elif self.meta.has_section('IMDB') and self.meta.has_option('IMDB', item):
-            return self.meta.get('IMDB', item).rstrip(' | ')
-        else:
-            raise KeyError(item)
+        for section in ('local', 'IMDB'):
+            if item in self.meta.get(section, {}):
+                return self.meta[section][item].rstrip(' | ')
+        raise KeyError(item)
 
     def __contains__(self, item):
-        if self.meta.has_section('local') and self.meta.has_option('local', item):
-            return True
-        elif self.meta.has_section('IMDB') and self.meta.has_option('IMDB', item):
-            return True
-        else:
-            return False
+        return any(item in self.meta.get(section, {}) for section in ('local', 'IMDB'))
+
+
+def _parse_info(path):
+    """Parse a UPMC .info file into {section: {key: value}}"""
+    # No interpolation, otherwise any '%' in a URL or plot summary is an error
+    meta = configparser.ConfigParser(interpolation=None)
+    try:
+        meta.read(path)
+    except (configparser.Error, UnicodeDecodeError) as e:
+        print("WARNING: Couldn't parse", path, e, file=sys.stderr)
+        return {}
+    return {section: dict(meta.items(section)) for section in meta.sections()}
+
+
+class _MetadataStore():
+    """Persistent store of the parsed contents of every .info file, keyed on the file's path.
+
+    The mtime & size are stored alongside, so a changed file is simply parsed again next time it's looked up.
+    Everything is also kept in memory, so a lookup costs no more than a stat() call.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # NOTE: Flask is running threaded, so I'm sharing the one connection with a lock around it.
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, meta TEXT)')
+        self._memory = {path: (size, mtime, json.loads(meta)) for path, size, mtime, meta in
+                        self._db.execute('SELECT path, size, mtime, meta FROM metadata')}
+        # Rows parsed on demand that are yet to be written, see _queue_store()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+
+    def get(self, path):
+        st = os.stat(path)
+        cached = self._memory.get(path)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+        meta = _parse_info(path)
+        self._memory[path] = (st.st_size, st.st_mtime_ns, meta)
+        self._queue_store((path, st.st_size, st.st_mtime_ns, meta))
+        return meta
+
+    def _queue_store(self, row):
+        # Listing a folder the import hasn't got to yet parses every .info file in it one after the other,
+        # so hang on a moment for the rest of them rather than committing each one on its own.
+        with self._pending_lock:
+            self._pending.append(row)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(_CONFIG_METADATA_WRITE_DELAY, self._flush)
+                self._flush_timer.name = 'metadata-writer'
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush(self):
+        with self._pending_lock:
+            rows, self._pending = self._pending, []
+            self._flush_timer = None
+        if rows:
+            self._store(rows)
+
+    def _store(self, rows):
+        for path, size, mtime, meta in rows:
+            self._memory[path] = (size, mtime, meta)
+        with self._db_lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                                 [(path, size, mtime, json.dumps(meta)) for path, size, mtime, meta in rows])
+            self._db.execute('COMMIT')
+
+    def _parse_if_changed(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self._memory.get(path)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return None
+        return (path, st.st_size, st.st_mtime_ns, _parse_info(path))
+
+    def import_all(self, root):
+        """Parse every new or changed .info file under root, and forget about any that have gone away"""
+        paths = [os.path.join(dirpath, filename)
+                 for dirpath, dirnames, filenames in os.walk(root)
+                 for filename in filenames if filename.endswith('.info')]
+        # Mostly waiting on the NFS server for the file contents, so threads are plenty for this
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_CONFIG_METADATA_IMPORT_THREADS) as executor:
+            rows = [row for row in executor.map(self._parse_if_changed, paths) if row is not None]
+        if rows:
+            self._store(rows)
+
+        found = set(paths)
+        gone = [path for path in list(self._memory) if path.startswith(root + os.path.sep) and path not in found]
+        for path in gone:
+            self._memory.pop(path, None)
+        with self._db_lock:
+            self._db.executemany('DELETE FROM metadata WHERE path = ?', [(path,) for path in gone])
+        print("Imported", len(rows), "changed .info files,", len(gone), "removed", file=sys.stderr)
+
+
+_metadata_store = _MetadataStore(os.path.join(cache.CACHE_DIR, 'metadata.sqlite'))
+
+
+def get_cover(info_path):
+    """Get the remote cover Image named by a UPMC .info file, the path being relative to the media directory"""
+    metadata = _Metadata(info_path)
+    if 'full-size cover url' not in metadata:
+        raise FileNotFoundError(errno.ENOENT, "No cover for", info_path)
+    # FIXME: Don't assume JPEG!
+    return Image(metadata['full-size cover url'], mimetype='image/jpeg', info_path=metadata._fullpath)
+
+
+def get_metadata(fullpath):
+    """Get the contents of a UPMC .info file as {section: {key: value}}, only parsing it if it's changed"""
+    return _metadata_store.get(fullpath)
 
 
 class Video(File):
@@ -149,139 +339,190 @@ class Video(File):
 
 
 class Image(File):
-    def __init__(self, path, *args, **kwargs):
+    # The .info file a remote image's URL came from, which is how the client refers to it, see get_cover()
+    _info_path = None
+
+    def __init__(self, path, *args, info_path=None, **kwargs):
         self._uri = urllib.parse.urlparse(path)
         if self._uri.netloc:
             self._islocal = False
+            self._info_path = info_path
 
         super().__init__(path, *args, **kwargs)
         self.preview = self
 
-    def get_thumbnail(self, size=(280, 180)):  # FIXME: Default size inherited from UPMC, get a better size
+    def get_thumbnail(self, size=THUMBNAIL_SIZE):
+        assert isinstance(size, tuple)
+        assert len(size) == 2
+        x, y = size
         if self._islocal:
-            assert isinstance(size, tuple)
-            assert len(size) == 2
+            # The mtime is in the URL so that browsers can cache it forever without ever getting a stale thumbnail
+            return "/thumb/{x}x{y}/{path}?v={mtime}".format(
+                x=x, y=y, path=urllib.parse.quote(self._relpath), mtime=os.stat(self._fullpath).st_mtime_ns)
+        elif self._info_path:
+            # Remote images get fetched & thumbnailed by the server, rather than every client going to the CDN for them.
+            return "/cover/{x}x{y}/{path}?v={mtime}".format(
+                x=x, y=y, path=urllib.parse.quote(os.path.relpath(self._info_path, start=_CONFIG_MEDIA_PATH)),
+                mtime=os.stat(self._info_path).st_mtime_ns)
+        else:
+            # Nothing the /cover route can find it by, so just return the full-size URL and hope the CSS takes care of it.
+            return self.get_remote_url()
+
+    def get_remote_url(self):
+        """The URL of the full-size remote image"""
+        assert not self._islocal, "Not a remote image"
+        uri = self._uri
+        if uri.netloc.endswith('-amazon.com') or uri.netloc.endswith('-imdb.com'):
+            # IMDB's CDNs, so it's safe to assume IMDB's URI format for size conversions
+            # NOTE: I don't actually understand this format *AT ALL* I just barely reverse-engineered it enough to get the required result.
+            if uri.path.endswith('_.jpg'):
+                # This is not the *full-size* uri! Oh well, lets rip it apart and fix that.
+                path = uri.path.rsplit('.', 3)[0]
+                path += '.jpg'  # FIXME: Don't assume JPEG
+                # FIXME: _replace is an internal function, don't use it!
+                uri = uri._replace(path=path)
+        return urllib.parse.urlunparse(uri)
+
+    def get_thumbnail_file(self, size=THUMBNAIL_SIZE):
+        """Return the path to a cached PNG thumbnail of this image, generating it first if needed.
+
+        Remote images get downloaded first, which can raise covers.FetchError.
+        """
+        source_path = self._fullpath if self._islocal else covers.fetch(self.get_remote_url())
+        key = _thumbnail_cache.key(*cache.media_key(source_path), tuple(size))
+        thumb_path = _thumbnail_cache.get(key)
+        metrics.cache_lookups.inc(cache='thumbnail', result='miss' if thumb_path is None else 'hit')
+        if thumb_path is None:
             image_buffer = io.BytesIO()
-            im = PIL.Image.open(self._fullpath)
+            im = PIL.Image.open(source_path)
             im.thumbnail(size=size)
             im.save(image_buffer, format='png')  # FIXME: Is PNG reasonable? Not using JPEG because I want alpha channel support
-            image_buffer.seek(0)
-            b64_data = base64.b64encode(image_buffer.read())
+            thumb_path = _thumbnail_cache.put(key, image_buffer.getvalue())
             image_buffer.close()
-            return "data:image/png;base64," + b64_data.decode('ascii')
-        else:
-            if self._uri.netloc.endswith('-amazon.com') or self._uri.netloc.endswith('-imdb.com'):
-                # IMDB's CDNs, so it's safe to assume IMDB's URI format for size conversions
-                # NOTE: I don't actually understand this format *AT ALL* I just barely reverse-engineered it enough to get the required result.
-                if self._uri.path.endswith('_.jpg'):
-                    # This is not the *full-size* uri! Oh well, lets rip it apart and fix that.
-                    path = self._uri.path.rsplit('.', 3)[0]
-                    path += '.jpg'  # FIXME: Don't assume JPEG
-                    # FIXME: _replace is an internal function, don't use it!
-                    self._uri = self._uri._replace(path=path)
-
-                base_path, ext = self._uri.path.rsplit('.', 1)
-                x, y = size
-
-                return self._uri._replace(params=self.sortkey[1],
-                                          path="{base_path}._V1._SX{x}_SY{y}_.{ext}".format(
-                                              base_path=base_path, ext=ext, x=x, y=y)
-                                          ).geturl()
-            else:
-                # Not IMDB, fuck it just return the full-size URL and hope the CSS takes care of it.
-                return urllib.parse.urlunparse(self._uri)
+        return thumb_path
 
 
 class Folder(vfs_Object):
     """Folder class, iterate across this to get File/Video/Image objects for each directory entry"""
     _isfile = False
+    _mimetype = 'inode/directory'
+
+    _preview = None
+    _preview_loaded = False
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # FIXME: This criteria stolen from UPMC.
-        #        Reasonable while still using the UPMC storage backend, but should get tidied up later,
-        #        probably by just going "No! The folder preview must be a png..." etc.
-        for ext in ['.jpg', '.png', '.jpeg', '.gif']:
-            for filename in ['folder' + ext, '.folder' + ext, 'folder' + ext.upper(), '.folder' + ext.upper()]:
-                try: self.preview = Image(os.path.join(self._fullpath, filename))  # noqa: E701
-                except FileNotFoundError: continue  # noqa: E701
-                else: break  # noqa: E701
+    @property
+    def preview(self):
+        """The folder's cover image, only looked up when it's actually wanted since that means listing the folder"""
+        if not self._preview_loaded:
+            preview = _library_index.get(self._fullpath).preview
+            if preview:
+                self._preview = Image(os.path.join(self._fullpath, preview))
+            self._preview_loaded = True
+        return self._preview
+
+    @property
+    def etag(self):
+        """Changes whenever this folder's listing might have changed"""
+        return _library_index.get(self._fullpath).etag
 
     def __iter__(self):
-        self._index = 0
-        self._objects = {}
-        # Since dicts are not sorted, I keep a separately sorted list of the dict keys
-        # FIXME: This name is misleading as it's not actually sorted until after the loop
-        self._sorted_list = []
-        for entry in os.scandir(self._fullpath):
-            # If it's not hidden, and it is a file or directory (therefore not a broken symlink)
-            # FIXME: Add a "show_hidden" flag somehow?
-            if not entry.name.startswith('.') and (entry.is_file() or entry.is_dir()):
-                sortkey = _get_sortkey(entry)
-                if sortkey not in self._objects:
-                    self._sorted_list.append(sortkey)
-                    self._objects[sortkey] = []
-                self._objects[sortkey].append(entry)
-        self._sorted_list.sort()
-        return self
-
-    def __next__(self):
-        if self._index >= len(self._objects):
-            raise StopIteration
+        return self.iterate()
+
+    def iterate(self, after=None):
+        """Yield each entry in sorted order, starting from just after the sortkey after (if given)"""
+        return self.map(None, after=after)
+
+    def map(self, func, after=None):
+        """Yield func(entry) for each entry in sorted order, starting from just after the sortkey after (if given).
+
+        Building each entry (and calling func on it) is mostly waiting on stat() & read() calls,
+        so that's done a few at a time on a thread pool, but everything still comes out in order.
+        NOTE: func mustn't list any folders itself, or it could end up waiting on the thread pool it's running in.
+        """
+        listing = _library_index.get(self._fullpath)
+        start = 0 if after is None else bisect.bisect_right(listing.sortkeys, after)
+        sortkeys = iter(listing.sortkeys[start:])
+        pending = collections.deque()
+
+        def submit_next():
+            sortkey = next(sortkeys, None)
+            if sortkey is None:
+                return
+            if func is None and sortkey in listing.objects:
+                # Already built, no need to bother the thread pool
+                future = concurrent.futures.Future()
+                future.set_result((listing.objects[sortkey], listing.objects[sortkey]))
+                pending.append(future)
+            else:
+                pending.append(_listing_pool.submit(self._build, listing, sortkey, func))
+
+        # Keep the pool busy, but don't get too far ahead in case the caller stops early
+        for _ in range(_CONFIG_LISTING_THREADS * 2):
+            submit_next()
+        while pending:
+            obj, result = pending.popleft().result()
+            submit_next()
+            if obj is not None:
+                yield result
+            # Otherwise there's nothing worth showing for this entry, so skip it and move on.
+
+    def _build(self, listing, sortkey, func):
+        # The listing keeps hold of everything that's been built, so the next request for this folder needn't redo it
+        if sortkey not in listing.objects:
+            listing.objects[sortkey] = self._materialise(sortkey, listing.groups[sortkey])
+        obj = listing.objects[sortkey]
+        return obj, (obj if func is None or obj is None else func(obj))
+
+    def _materialise(self, sortkey, entries):
+        if len(entries) == 1:
+            entry, = entries
+            if entry.is_dir:
+                return Folder(entry.path, sortkey=sortkey)
+            else:
+                print("WARNING: No metadata for", entry.path, file=sys.stderr)
+                return self._get_file(entry.path, sortkey=sortkey, mimetype=entry.mimetype)
         else:
-            sortkey = self._sorted_list[self._index]
-            self._index += 1
-            if len(self._objects[sortkey]) == 1:
-                entry, = self._objects[sortkey]
-                if entry.is_dir():
-                    return Folder(entry.path, sortkey=sortkey)
+            # Multiple associated files to deal with.
+            video = None
+            image = None
+            metadata = None
+            for entry in entries:
+                assert not entry.is_dir, "Directories shouldn't have extensions"
+                f = self._get_file(entry.path, sortkey=sortkey, mimetype=entry.mimetype)
+                if isinstance(f, Video):
+                    video = f
+                elif isinstance(f, Image):
+                    image = f
+#                elif isinstance(f, Subtitles):
+#                    subtitles = f
+                elif isinstance(f, _Metadata):
+                    metadata = f
                 else:
-                    print("WARNING: No metadata for", entry.path, file=sys.stderr)
-                    return self._get_file(entry.path, sortkey=sortkey)
+                    # Unrecognised file, just going to ignore this one.
+                    pass
+            if metadata is not None and 'full-size cover url' in metadata:
+                # FIXME: Don't assume JPEG!
+                image = Image(metadata['full-size cover url'], mimetype='image/jpeg', sortkey=sortkey,
+                              info_path=metadata._fullpath)
+
+            if video is None and image is None:
+                # No associated video or image file found
+                return None
+            elif video is None:
+                # There's an image but no associated video
+                return image
+            elif image is None:
+                # There's a video but no associated image
+                # No other part of the code really does anything with this yet, but I'll return it as is anyway
+                return video
             else:
-                # Multiple associated files to deal with.
-                video = None
-                image = None
-                metadata = None
-                for entry in self._objects[sortkey]:
-                    assert not entry.is_dir(), "Directories shouldn't have extensions"
-                    f = self._get_file(entry.path, sortkey=sortkey)
-                    if isinstance(f, Video):
-                        video = f
-                    elif isinstance(f, Image):
-                        image = f
-#                    elif isinstance(f, Subtitles):
-#                        subtitles = f
-                    elif isinstance(f, _Metadata):
-                        metadata = f
-                    else:
-                        # Unrecognised file, just going to ignore this one.
-                        pass
-                if metadata is not None and 'full-size cover url' in metadata:
-                    # FIXME: Don't assume JPEG!
-                    image = Image(metadata['full-size cover url'], mimetype='image/jpeg', sortkey=sortkey)
-
-                if video is None and image is None:
-                    # No associated video or image file found, so skip this entry and move on.
-                    return self.__next__()
-                elif video is None:
-                    # There's an image but no associated video
-                    return image
-                elif image is None:
-                    # There's a video but no associated image
-                    # No other part of the code really does anything with this yet, but I'll return it as is anyway
-                    return video
-                else:
-                    # There's both an image and a video
-                    video.preview = image
-                    return video
-
-            raise Exception("Reaching this point should be impossible")
+                # There's both an image and a video
+                video.preview = image
+                return video
 
-    def _get_file(self, path, sortkey):
-        # FIXME: Make the magic DB smaller & more efficient, this is the slowest part of all
-        # FIXME: Make the magic DB recognise SRT files.
-        mimetype = magic_db.file(path)
+    def _get_file(self, path, sortkey, mimetype=None):
+        if mimetype is None:
+            mimetype = _get_mimetype(path)
         type_cat = mimetype.partition('/')[0]
         if type_cat == 'video':
             return Video(path, mimetype=mimetype, sortkey=sortkey)
@@ -308,6 +549,368 @@ class Folder(vfs_Object):
             return self._get_file(fullpath, sortkey=sortkey)
 
 
+# FIXME: This criteria stolen from UPMC.
+#        Reasonable while still using the UPMC storage backend, but should get tidied up later,
+#        probably by just going "No! The folder preview must be a png..." etc.
+_FOLDER_PREVIEW_NAMES = [filename
+                         for ext in ['.jpg', '.png', '.jpeg', '.gif']
+                         for filename in ['folder' + ext, '.folder' + ext, 'folder' + ext.upper(), '.folder' + ext.upper()]]
+
+_listing_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_CONFIG_LISTING_THREADS, thread_name_prefix='listing')
+_search_updates = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='search-index')
+
+# Just enough of the os.DirEntry to recreate the vfs objects later
+_IndexEntry = collections.namedtuple('_IndexEntry', ('name', 'path', 'is_dir', 'mimetype'))
+
+
+class _Listing():
+    """Snapshot of one directory's entries, grouped by sortkey"""
+
+    def __init__(self, fullpath, etag):
+        self.etag = etag
+        # Get the mtime before scanning so that any changes made during the scan will be noticed next time
+        self.mtime_ns = os.stat(fullpath).st_mtime_ns
+        self.groups = {}
+        # Filled in lazily by Folder.map as each group gets turned into a vfs object
+        self.objects = {}
+        self.preview = None
+
+        # The preview gets picked out of the same scan, rather than stat()ing each possible name
+        preview_files = set()
+        for entry in os.scandir(fullpath):
+            if entry.name in _FOLDER_PREVIEW_NAMES and entry.is_file():
+                preview_files.add(entry.name)
+            # If it's not hidden, and it is a file or directory (therefore not a broken symlink)
+            # FIXME: Add a "show_hidden" flag somehow?
+            if not entry.name.startswith('.') and (entry.is_file() or entry.is_dir()):
+                is_dir = entry.is_dir()
+                self.groups.setdefault(_get_sortkey(entry), []).append(_IndexEntry(
+                    name=entry.name, path=entry.path, is_dir=is_dir,
+                    mimetype=None if is_dir else _get_mimetype(entry.path)))
+        self.sortkeys = sorted(self.groups)
+
+        for filename in _FOLDER_PREVIEW_NAMES:
+            if filename in preview_files:
+                self.preview = filename
+                break
+
+
+class _LibraryIndex():
+    """In-memory cache of every directory listing in the library.
+
+    Directories being watched with inotify are trusted until an event says otherwise,
+    anything else has its mtime checked on every lookup.
+    """
+    _WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+                   inotify.IN_CLOSE_WRITE | inotify.IN_DELETE_SELF | inotify.IN_ONLYDIR)
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+        # Bumped every time a directory is invalidated, so a scan that raced with a change doesn't get kept
+        self._invalidations = collections.Counter()
+        # The ETag needs to change across restarts as well, hence the start time in there
+        self._etag_prefix = '{:x}'.format(int(time.time()))
+        self._generation = itertools.count()
+        self._inotify = None
+        self._watches = {}  # wd -> directory path
+        self._watched = set()
+        self._root = None
+        # Called with the full path & mimetype of every file that turns up in the library once it's finished being written
+        self._new_file_listeners = []
+
+    def get(self, fullpath):
+        fullpath = os.path.normpath(fullpath)
+        listing = self._listings.get(fullpath)
+        if listing is not None:
+            # FIXME: inotify only sees changes made by this machine, so changes made on the NFS server directly won't be noticed.
+            if fullpath in self._watched:
+                return listing
+            elif os.stat(fullpath).st_mtime_ns == listing.mtime_ns:
+                return listing
+
+        invalidations = self._invalidations[fullpath]
+        listing = _Listing(fullpath, etag='{}-{:x}'.format(self._etag_prefix, next(self._generation)))
+        with self._lock:
+            current = self._invalidations[fullpath] == invalidations
+            if current:
+                self._listings[fullpath] = listing
+        if current:
+            # Reading every .info file for the search index takes far longer than the listing did,
+            # so leave that to the background rather than holding up whoever asked for the listing.
+            self._update_search(self._refresh_search, fullpath, listing)
+        return listing
+
+    def _update_search(self, func, *args):
+        # All the search index changes go through the one thread, so they happen in the order they were asked for
+        _search_updates.submit(func, *args)
+
+    def _refresh_search(self, fullpath, listing):
+        if self._listings.get(fullpath) is not listing:
+            # It's changed since, so whatever replaced it will be along shortly
+            return
+        try:
+            _search_index.replace_group(fullpath, _search_docs(listing))
+        except Exception as e:
+            print("WARNING: Couldn't update search index for", fullpath, e, file=sys.stderr)
+
+    def invalidate(self, fullpath):
+        with self._lock:
+            self._invalidations[fullpath] += 1
+            self._listings.pop(fullpath, None)
+        _resolved.invalidate(fullpath)
+
+    def is_watched(self, dirpath):
+        """Whether inotify will tell us about any changes to dirpath"""
+        return dirpath in self._watched
+
+    def start(self, root):
+        """Start watching everything under root for changes, and build the index for it in the background"""
+        self._root = root
+        try:
+            self._inotify = inotify.Inotify()
+        except OSError as e:
+            print("WARNING: Can't use inotify, falling back to checking directory mtimes:", e, file=sys.stderr)
+        else:
+            threading.Thread(target=self._watch_loop, name='library-index-watcher', daemon=True).start()
+        threading.Thread(target=self._build, args=(root,), name='library-index-builder', daemon=True).start()
+
+    def _build(self, root, new_files=False):
+        """Index everything under root, and if new_files tell the new file listeners about every file in there too"""
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            # Watch it before scanning it, so nothing can change between the two unnoticed
+            self._watch(dirpath)
+            try:
+                self.get(dirpath)
+            except OSError as e:
+                print("WARNING: Couldn't index", dirpath, e, file=sys.stderr)
+            if new_files:
+                # A whole folder moved in (such as a new season) doesn't get an event for each file in it,
+                # and anything copied in before it was being watched won't have had one either.
+                for filename in filenames:
+                    if not filename.startswith('.'):
+                        self._new_file(os.path.join(dirpath, filename))
+
+    def _watch(self, dirpath):
+        if self._inotify is None:
+            return
+        try:
+            wd = self._inotify.add_watch(dirpath, self._WATCH_MASK)
+        except OSError as e:
+            # Most likely ENOSPC, having run out of fs.inotify.max_user_watches.
+            # The directory still works, it just gets its mtime checked every time.
+            print("WARNING: Can't watch", dirpath, e, file=sys.stderr)
+        else:
+            self._watches[wd] = dirpath
+            self._watched.add(dirpath)
+
+    def _watch_loop(self):
+        while True:
+            # Rescanned once each batch of events is dealt with, so the search index stays up to date
+            changed = set()
+            for event in self._inotify.read():
+                if event.mask & inotify.IN_Q_OVERFLOW:
+                    # Events got lost, so there's no telling what's changed.
+                    for dirpath in list(self._listings):
+                        self.invalidate(dirpath)
+                    threading.Thread(target=self._build, args=(self._root,),
+                                     name='library-index-builder', daemon=True).start()
+                    continue
+
+                dirpath = self._watches.get(event.wd)
+                if dirpath is None:
+                    continue
+                if event.mask & inotify.IN_IGNORED:
+                    # The kernel dropped the watch, most likely because the directory was deleted
+                    del self._watches[event.wd]
+                    self._watched.discard(dirpath)
+                    self.invalidate(dirpath)
+                    self._update_search(_search_index.remove_group, dirpath)
+                    continue
+
+                self.invalidate(dirpath)
+                changed.add(dirpath)
+                # The parent's listing has this directory's preview image in it
+                self.invalidate(os.path.dirname(dirpath))
+                if event.mask & inotify.IN_ISDIR and event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    if not event.name.startswith('.'):
+                        # Could be a whole lot in there, so don't hold up the rest of the events on it
+                        threading.Thread(target=self._build, args=(os.path.join(dirpath, event.name),),
+                                         kwargs={'new_files': True}, name='library-index-builder', daemon=True).start()
+                elif event.mask & inotify.IN_ISDIR and event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    # Everything that was under it has gone too, and if it comes back it'll need scanning again
+                    gone = os.path.join(dirpath, event.name)
+                    for path in set(self._listings) | set(_search_index.groups()):
+                        if path == gone or path.startswith(gone + os.path.sep):
+                            self._watched.discard(path)
+                            self.invalidate(path)
+                            self._update_search(_search_index.remove_group, path)
+                elif event.mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO) and not event.name.startswith('.'):
+                    self._new_file(os.path.join(dirpath, event.name))
+
+            for dirpath in changed:
+                if dirpath in self._watched:
+                    try:
+                        self.get(dirpath)
+                    except OSError as e:
+                        print("WARNING: Couldn't index", dirpath, e, file=sys.stderr)
+
+    def _new_file(self, fullpath):
+        for listener in self._new_file_listeners:
+            try:
+                listener(fullpath, _get_mimetype(fullpath))
+            except Exception as e:
+                # Don't let one broken listener kill the watcher thread
+                print("WARNING: New file listener", listener, "failed on", fullpath, e, file=sys.stderr)
+
+    def add_new_file_listener(self, callback):
+        self._new_file_listeners.append(callback)
+
+
+def _search_docs(listing):
+    """What the search index should know about each of a listing's entries, see search.Index.replace_group"""
+    root = os.path.abspath(_CONFIG_MEDIA_PATH)
+    for sortkey, entries in listing.groups.items():
+        # Only folders & videos are worth finding, same as the browser only bothers showing those
+        main_entry = next((e for e in entries if e.is_dir), None) or \
+            next((e for e in entries if e.mimetype.startswith('video/')), None)
+        if main_entry is None:
+            continue
+
+        fields = []
+        for entry in entries:
+            if entry.path.endswith('.info'):
+                try:
+                    meta = get_metadata(entry.path)
+                except OSError:
+                    continue
+                fields.extend(value for section in ('local', 'IMDB') for key, value in meta.get(section, {}).items()
+                              if 'url' not in key and len(value) <= _CONFIG_SEARCH_MAX_FIELD_LENGTH)
+
+        display_name = main_entry.name if main_entry.is_dir else main_entry.name.rsplit('.', 1)[0]
+        # Searched with the article moved to the end like the sortkey, so "truman" counts as starting with what's searched
+        # for, and "the truman" still finds it.
+        # NOTE: Not the sortkey itself, since for files that loses the article along with the extension.
+        name = _get_sortkey(name=display_name, is_file=False)[1]
+        # And every folder it's in (up to the library itself), so "foo s01" finds "Foo/S01/" and the episodes in it
+        parents = os.path.relpath(os.path.dirname(main_entry.path), root)
+        if parents != os.path.curdir:
+            fields.extend(parents.split(os.path.sep))
+        yield name, ' '.join(fields), sortkey, {
+            'is_file': not main_entry.is_dir,
+            'mimetype': 'inode/directory' if main_entry.is_dir else main_entry.mimetype,
+            'name': display_name,
+            'path': os.path.relpath(main_entry.path, root),
+            'sortkey': sortkey,
+        }
+
+
+class _ResolvedPaths():
+    """Cache of what each path in the library really is, so the symlinks only need following the once.
+
+    Every alias of a file (such as Latest/Foo-S01E01 -> TV/Foo/S01E01) resolves to the same canonical path,
+    and the same media ID, that being the (st_dev, st_ino) of wherever the symlinks finally end up.
+    An answer is trusted for as long as each directory the symlinks went through is either watched by the library
+    index (until it says otherwise), or still has the same mtime it did.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resolved = {}  # path -> (canonical path, media ID, is_dir, {dirpath: mtime_ns})
+        self._by_dir = collections.defaultdict(set)  # dirpath -> every path resolved through it
+
+    def _still_valid(self, dir_mtimes):
+        for dirpath, mtime_ns in dir_mtimes.items():
+            if _library_index.is_watched(dirpath):
+                continue
+            try:
+                if os.stat(dirpath).st_mtime_ns != mtime_ns:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def resolve(self, path):
+        cached = self._resolved.get(path)
+        if cached is not None and self._still_valid(cached[3]):
+            return cached[:3]
+
+        dir_mtimes = {}
+        try:
+            canonical = _get_last_rel_link_in_media_dir(path, dir_mtimes=dir_mtimes)
+            if os.path.islink(canonical):
+                # It leads out of the library, so keep an eye on wherever it finally ends up too
+                target_dir = os.path.dirname(os.path.realpath(canonical))
+                dir_mtimes.setdefault(target_dir, os.stat(target_dir).st_mtime_ns)
+            # This follows those symlinks as well, so even they share the one media ID
+            st = os.stat(canonical)
+        except NotADirectoryError as e:
+            # Such as 'foo.mkv/bar', which as far as anyone else cares just doesn't exist
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", path) from e
+        resolved = (canonical, (st.st_dev, st.st_ino), stat.S_ISDIR(st.st_mode))
+        with self._lock:
+            self._resolved[path] = resolved + (dir_mtimes,)
+            for dirpath in dir_mtimes:
+                self._by_dir[dirpath].add(path)
+        return resolved
+
+    def invalidate(self, dirpath):
+        with self._lock:
+            for path in self._by_dir.pop(dirpath, ()):
+                self._resolved.pop(path, None)
+
+
+_library_index = _LibraryIndex()
+_resolved = _ResolvedPaths()
+_search_index = search.Index()
+
+
+def resolve(fullpath: str):
+    """Follow fullpath's symlinks (as far as they stay in the library), returns (canonical path, media ID, is_dir).
+
+    The media ID is the same for every alias of a file, so anything keyed on it is shared between them.
+    Raises FileNotFoundError if it doesn't exist.
+    """
+    return _resolved.resolve(fullpath)
+
+
+def start_library_index():
+    """Index the whole media library in the background, and keep that index up to date"""
+    _library_index.start(os.path.abspath(_CONFIG_MEDIA_PATH))
+    threading.Thread(target=_metadata_store.import_all, args=(os.path.abspath(_CONFIG_MEDIA_PATH),),
+                     name='metadata-import', daemon=True).start()
+
+
+def add_new_file_listener(callback):
+    """Call callback(fullpath, mimetype) whenever a new file finishes arriving in the library.
+
+    NOTE: Only works when inotify does, and only once start_library_index() has been called.
+    """
+    _library_index.add_new_file_listener(callback)
+
+
+def search_library(query: str, limit=50):
+    """Find folders & videos with every word of query in their name, or their .info file.
+
+    This only looks in the index, so it only knows about what start_library_index() has found so far.
+    Results are dicts of the same things as ls.json has, best matches first.
+    """
+    return _search_index.search(query, limit=limit)
+
+
+def get_next_video(path):
+    """Return the Video that comes after path in its folder, such as the next episode, or None if it's the last one"""
+    current = Video(path)
+    found = False
+    for obj in Folder(os.path.dirname(current.path)):
+        if found and isinstance(obj, Video):
+            return obj
+        elif obj._fullpath == current._fullpath:
+            found = True
+    return None
+
+
 def _get_sortkey(entry=None, name='', is_file=None):
     if entry is None:
         assert name and isinstance(is_file, bool)
@@ -338,12 +941,21 @@ def _get_sortkey(entry=None, name='', is_file=None):
     return sortkey
 
 
-def _get_last_rel_link_in_media_dir(path):
+def _get_last_rel_link_in_media_dir(path, dir_mtimes=None):
     # PROBLEM: Latest/Foo-S01E01 is a diferent URL from TV/Foo/S01E01 and therefore history isn't accurate
     # SOLUTION 1: os.path.realpath everything before making URLS
     # PROBLEM 2: Everything eventually links to the torrents directory, which we don't serve out
     # SOLUTION 2: Reimplement realpath ourselves with a constraint that it not leave the media directory
-    while os.path.islink(path):
+    # NOTE: Use resolve() instead, which caches this.
+    #       If dir_mtimes is given, the mtime of each directory this goes through gets put in it,
+    #       taken before looking at the directory so any change made while looking gets noticed next time.
+    while True:
+        if dir_mtimes is not None:
+            dirpath = os.path.dirname(path)
+            if dirpath not in dir_mtimes:
+                dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+        if not os.path.islink(path):
+            break
         link_path = os.readlink(path)
 
         if not link_path.startswith(os.path.sep):